@@ -0,0 +1,173 @@
+import os
+import threading
+from typing import Dict, Optional, Sequence
+
+from metrics import REGISTRY, Counter, Gauge
+
+ADMISSION_REJECTIONS = REGISTRY.register(Counter(
+    'heartscope_admission_rejections_total',
+    'Requests rejected by admission control',
+    ('reason',),
+))
+IN_FLIGHT_IMAGES = REGISTRY.register(Gauge(
+    'heartscope_in_flight_images',
+    'Images admitted and not yet answered',
+))
+QUEUED_BYTES = REGISTRY.register(Gauge(
+    'heartscope_queued_bytes',
+    'Upload bytes held by admitted requests',
+))
+
+# Room for multipart boundaries and part headers on top of the file bytes
+_MULTIPART_OVERHEAD = 64 * 1024
+
+
+class AdmissionError(Exception):
+    """A request is over an admission limit.
+
+    ``retryable`` is True when the server is saturated and the same request
+    may succeed later, False when the request itself is too large.
+    """
+
+    def __init__(self, reason: str, message: str, retryable: bool):
+        super().__init__(message)
+        self.reason = reason
+        self.retryable = retryable
+
+
+class Reservation:
+    """Capacity held by one admitted request; release exactly once"""
+
+    def __init__(self, controller: "AdmissionController", images: int, nbytes: int):
+        self._controller = controller
+        self.images = images
+        self.nbytes = nbytes
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.images, self.nbytes)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    """Bounds the work the server accepts at once.
+
+    Per-request limits (file count and size) reject requests that could
+    never be served. Global limits on in-flight images and queued upload
+    bytes reject requests while the node is saturated, so clients back off
+    via Retry-After instead of piling up until memory runs out.
+    """
+
+    def __init__(self, max_in_flight_images: int = 64, max_queued_bytes: int = 256 * 1024 * 1024,
+                 max_files: int = 32, max_file_bytes: int = 25 * 1024 * 1024,
+                 retry_after: int = 1):
+        self.max_in_flight_images = max(1, max_in_flight_images)
+        self.max_queued_bytes = max(1, max_queued_bytes)
+        self.max_files = max(1, min(max_files, self.max_in_flight_images))
+        self.max_file_bytes = max(1, max_file_bytes)
+        self.retry_after = max(1, retry_after)
+
+        self.in_flight_images = 0
+        self.queued_bytes = 0
+        self.admitted = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        """Build limits from ADMIT_MAX_IN_FLIGHT / ADMIT_MAX_QUEUED_MB / ADMIT_MAX_FILES / ADMIT_MAX_FILE_MB"""
+        return cls(
+            max_in_flight_images=int(os.getenv('ADMIT_MAX_IN_FLIGHT', '64')),
+            max_queued_bytes=int(float(os.getenv('ADMIT_MAX_QUEUED_MB', '256')) * 1024 * 1024),
+            max_files=int(os.getenv('ADMIT_MAX_FILES', '32')),
+            max_file_bytes=int(float(os.getenv('ADMIT_MAX_FILE_MB', '25')) * 1024 * 1024),
+            retry_after=int(os.getenv('ADMIT_RETRY_AFTER', '1')),
+        )
+
+    @property
+    def max_request_bytes(self) -> int:
+        return min(self.max_files * self.max_file_bytes, self.max_queued_bytes) + _MULTIPART_OVERHEAD
+
+    def _reject(self, reason: str, message: str, retryable: bool = False):
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        raise AdmissionError(reason, message, retryable)
+
+    def check_content_length(self, content_length: Optional[int]):
+        """Reject an oversized body from its header, before it is read"""
+        if content_length is not None and content_length > self.max_request_bytes:
+            self._reject('request_bytes',
+                         f"Request body of {content_length} bytes exceeds {self.max_request_bytes}")
+
+    def check_capacity(self):
+        """Reject while saturated, before the body is received and spooled"""
+        with self._lock:
+            if self.in_flight_images >= self.max_in_flight_images:
+                reason = 'in_flight'
+            elif self.queued_bytes >= self.max_queued_bytes:
+                reason = 'queued_bytes'
+            else:
+                return
+        self._reject(reason, "Server is at capacity, retry later", retryable=True)
+
+    def admit(self, sizes: Sequence[int]) -> Reservation:
+        """Reserve capacity for a request's files (byte sizes) or raise AdmissionError"""
+        if len(sizes) > self.max_files:
+            self._reject('file_count', f"{len(sizes)} files exceed the limit of {self.max_files} per request")
+        for size in sizes:
+            if size > self.max_file_bytes:
+                self._reject('file_bytes', f"File of {size} bytes exceeds the limit of {self.max_file_bytes}")
+        nbytes = sum(sizes)
+        if nbytes > self.max_queued_bytes:
+            self._reject('request_bytes', f"Request of {nbytes} bytes exceeds {self.max_queued_bytes}")
+
+        with self._lock:
+            if self.in_flight_images + len(sizes) > self.max_in_flight_images:
+                reason = 'in_flight'
+            elif self.queued_bytes + nbytes > self.max_queued_bytes:
+                reason = 'queued_bytes'
+            else:
+                reason = None
+                self.in_flight_images += len(sizes)
+                self.queued_bytes += nbytes
+                self.admitted += 1
+                self._publish_locked()
+        if reason is not None:
+            self._reject(reason, "Server is at capacity, retry later", retryable=True)
+        return Reservation(self, len(sizes), nbytes)
+
+    def _release(self, images: int, nbytes: int):
+        with self._lock:
+            self.in_flight_images -= images
+            self.queued_bytes -= nbytes
+            self._publish_locked()
+
+    def _publish_locked(self):
+        IN_FLIGHT_IMAGES.set(self.in_flight_images)
+        QUEUED_BYTES.set(self.queued_bytes)
+
+    def saturated(self) -> bool:
+        with self._lock:
+            return (self.in_flight_images >= self.max_in_flight_images
+                    or self.queued_bytes >= self.max_queued_bytes)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            in_flight, queued = self.in_flight_images, self.queued_bytes
+        return {
+            "in_flight_images": in_flight,
+            "max_in_flight_images": self.max_in_flight_images,
+            "queued_bytes": queued,
+            "max_queued_bytes": self.max_queued_bytes,
+            "saturated": self.saturated(),
+            "admitted": self.admitted,
+            "rejected": {
+                reason: int(ADMISSION_REJECTIONS.value(reason=reason))
+                for reason in ('request_bytes', 'file_count', 'file_bytes', 'in_flight', 'queued_bytes')
+            },
+        }
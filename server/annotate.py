@@ -1,12 +1,13 @@
 import os
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from time import perf_counter
 
 import cv2
 import numpy as np
 import torch
-from inference import OptimizedYOLOInference, YOLOInference
+from inference import YOLOInference, get_inferencer
+from mask_encoding import CroppedMasks
 from PIL import Image
 
 from dotenv import load_dotenv
@@ -14,9 +15,15 @@ load_dotenv()
 
 
 class YOLOVisualizer:
-    def __init__(self, model_path: str):
-        """Initialize visualizer with inference model"""
-        self.inferencer = YOLOInference(model_path)
+    def __init__(self, model_path: Optional[str] = None, inferencer: Optional[YOLOInference] = None):
+        """Initialize visualizer, optionally backed by a shared inference model
+
+        Drawing only needs annotations, so the visualizer can be built without
+        a model. Passing ``model_path`` reuses the process-wide inferencer.
+        """
+        if inferencer is None and model_path is not None:
+            inferencer = get_inferencer(model_path)
+        self.inferencer = inferencer
         
         # Hot pink color (RGB) matching the reference image
         self.color = (255, 20, 147)  # RGB format
@@ -63,23 +70,68 @@ class YOLOVisualizer:
         return img
 
     def plot_boxes_and_masks(self, image: np.ndarray, annotations: dict) -> np.ndarray:
-        """Plot segmentation masks with boxes and labels"""
+        """Plot segmentation masks with boxes and labels
+
+        All masks are merged into one coverage map and blended in a single
+        pass over the covered pixels, so cost follows mask area rather than
+        detections x image size.
+        """
         img = image.copy()
         
         if not annotations or 'masks' not in annotations:
             return img
 
         masks = annotations['masks']
-        classes = annotations['classes']
-        boxes = annotations['boxes']
-        
-        for mask, cls_id, box in zip(masks, classes, boxes):
-            img = self.draw_annotations(img, mask, box, cls_id)
+        boxes = np.asarray(annotations['boxes'])
+        if len(masks) == 0:
+            return img
+
+        height, width = img.shape[:2]
+        mask_h, mask_w = masks.shape[1:3]
+        if (mask_h, mask_w) != (height, width):
+            # Masks still in letterbox space; fall back to the per-detection path
+            for mask, cls_id, box in zip(masks, annotations['classes'], boxes):
+                img = self.draw_annotations(img, mask, box, cls_id)
+            return img
+
+        # Count how many masks cover each pixel, touching only box regions.
+        # Masks can spill a pixel past their box after rescaling.
+        coverage = np.zeros((height, width), dtype=np.uint8)
+        regions = np.empty((len(boxes), 4), dtype=np.int64)
+        regions[:, :2] = np.floor(boxes[:, :2]) - 1
+        regions[:, 2:] = np.ceil(boxes[:, 2:]) + 1
+        regions = np.clip(regions, 0, [width, height, width, height])
+        if isinstance(masks, CroppedMasks):
+            # Crops already sit at their boxes; clip them to the same regions
+            for (crop, (x, y)), (x1, y1, x2, y2) in zip(masks.items(), regions):
+                cx1, cy1 = max(x, x1), max(y, y1)
+                cx2, cy2 = min(x + crop.shape[1], x2), min(y + crop.shape[0], y2)
+                if cx2 > cx1 and cy2 > cy1:
+                    coverage[cy1:cy2, cx1:cx2] += crop[cy1 - y:cy2 - y, cx1 - x:cx2 - x] > 0.5
+        else:
+            for mask, (x1, y1, x2, y2) in zip(masks, regions):
+                coverage[y1:y2, x1:x2] += mask[y1:y2, x1:x2] > 0.5
+
+        # Blend once: each covering mask adds alpha * color, like stacked addWeighted calls
+        covered = coverage > 0
+        if covered.any():
+            tint = coverage[covered, None] * (self.mask_alpha * np.array(self.color, dtype=np.float32))
+            img[covered] = np.clip(np.rint(img[covered] + tint), 0, 255).astype(img.dtype)
+
+        # Draw every bounding box with one polyline call
+        x1, y1, x2, y2 = boxes.astype(np.int32).T
+        rectangles = np.stack([
+            np.stack([x1, y1], axis=1), np.stack([x2, y1], axis=1),
+            np.stack([x2, y2], axis=1), np.stack([x1, y2], axis=1),
+        ], axis=1)
+        cv2.polylines(img, list(rectangles), True, self.color, 1)
 
         return img
 
     def process_image(self, image_path: str, output_path: str) -> bool:
         """Process a single image with segmentation visualization"""
+        if self.inferencer is None:
+            raise RuntimeError("YOLOVisualizer was created without an inference model")
         try:
             image = cv2.imread(image_path)
             if image is None:
@@ -104,6 +156,8 @@ class YOLOVisualizer:
 
     def process_batch(self, images: List[np.ndarray], batch_size: int = 4) -> List[Dict[str, Any]]:
         """Process a batch of images with segmentation support"""
+        if self.inferencer is None:
+            raise RuntimeError("YOLOVisualizer was created without an inference model")
         if not images:
             return []
 
@@ -115,25 +169,10 @@ class YOLOVisualizer:
             if self.inferencer.device == 'mps':
                 batch_size = min(batch_size, 2)
 
-            # Prepare batch
-            preprocessed = []
-            for img in images:
-                if isinstance(img, Image.Image):
-                    img = np.array(img)
-                prep_img, params = self.inferencer.preprocess_image(img)
-                preprocessed.append((prep_img, params))
-
-            # Run inference on batch
-            batch_results = self.inferencer.process_batch(
-                [p[0] for p in preprocessed],
-                batch_size
-            )
-
-            # Process results
-            for result, (_, params) in zip(batch_results, preprocessed):
-                if result:
-                    result['preprocessing_params'] = params
-                results.append(result)
+            # The inferencer letterboxes the batch and attaches
+            # preprocessing_params to each result itself
+            images = [np.array(img) if isinstance(img, Image.Image) else img for img in images]
+            results.extend(self.inferencer.process_batch(images, batch_size))
 
         except Exception as e:
             print(f"Error in batch processing: {e}")
@@ -146,8 +185,7 @@ class YOLOVisualizer:
 
 def process_single_image(model_path: str, image_file: Path, output_dir: Path) -> Path:
     """Process a single image file"""
-    visualizer = YOLOVisualizer(model_path)
-    visualizer.inferencer = OptimizedYOLOInference(model_path)
+    visualizer = YOLOVisualizer(inferencer=get_inferencer(model_path))
     
     output_path = output_dir / f"{image_file.stem}_pred{image_file.suffix}"
     success = visualizer.process_image(str(image_file), str(output_path))
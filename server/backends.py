@@ -0,0 +1,95 @@
+import functools
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+from ultralytics import YOLO
+
+from enhancement import get_enhance_mode
+
+# 'torch' runs the .pt weights eagerly; the others run an exported graph
+# through ultralytics' AutoBackend, which returns the same Results objects.
+# 'onnx-int8' is the ONNX graph statically quantized on local sample images,
+# preprocessed with the enhancement mode the model will be served with.
+BACKENDS = ('torch', 'onnx', 'openvino', 'onnx-int8')
+
+_export_lock = threading.RLock()
+
+
+def get_backend(backend: Optional[str] = None) -> str:
+    """Resolve the inference backend, defaulting to YOLO_BACKEND"""
+    backend = (backend or os.getenv('YOLO_BACKEND', 'torch')).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown YOLO backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def exported_path(model_path: str, backend: str, enhance: Optional[str] = None) -> Path:
+    """Where the exported graph for a .pt file is cached; INT8 graphs are cached per enhancement mode"""
+    weights = Path(model_path)
+    if backend == 'onnx':
+        return weights.with_suffix('.onnx')
+    if backend == 'openvino':
+        return weights.with_name(f"{weights.stem}_openvino_model")
+    if backend == 'onnx-int8':
+        return weights.with_suffix(f'.int8-{get_enhance_mode(enhance)}.onnx')
+    return weights
+
+
+def _is_fresh(target: Path, source: Path) -> bool:
+    return target.exists() and target.stat().st_mtime >= source.stat().st_mtime
+
+
+def _export_int8(model_path: str, target: Path, imgsz: int, enhance: str) -> str:
+    """Quantize the ONNX graph, reusing the cached one while weights and calibration set are unchanged"""
+    from quantization import calibration_fingerprint, calibration_images, letterbox, quantize_onnx
+
+    fingerprint_path = target.with_suffix('.calibration')
+    calibration_dir, paths = calibration_images()
+    fingerprint = calibration_fingerprint(paths, enhance)
+    if (_is_fresh(target, Path(model_path)) and fingerprint_path.exists()
+            and fingerprint_path.read_text() == fingerprint):
+        return str(target)
+
+    fp32_path = export_weights(model_path, 'onnx', imgsz)
+    print(f"Quantizing {fp32_path} to INT8 with '{enhance}' preprocessing (one-time)")
+    quantize_onnx(fp32_path, str(target), calibration_dir,
+                  preprocess=functools.partial(letterbox, target_size=imgsz, enhance=enhance))
+    fingerprint_path.write_text(fingerprint)
+    print(f"Quantized model cached at {target}")
+    return str(target)
+
+
+def export_weights(model_path: str, backend: str, imgsz: int = 1024, enhance: Optional[str] = None) -> str:
+    """Export .pt weights for a backend once, reusing the cached graph next to them.
+
+    ``enhance`` is the enhancement mode INT8 calibration images are
+    preprocessed with; it should match the mode the model serves with.
+    """
+    backend = get_backend(backend)
+    if backend == 'torch':
+        return model_path
+
+    source = Path(model_path)
+    target = exported_path(model_path, backend, enhance)
+    with _export_lock:
+        if backend == 'onnx-int8':
+            return _export_int8(model_path, target, imgsz, get_enhance_mode(enhance))
+
+        if _is_fresh(target, source):
+            return str(target)
+
+        print(f"Exporting {source} to {backend} (one-time)")
+        # Dynamic axes so batches of any size share the exported graph
+        exported = YOLO(str(source)).export(
+            format=backend,
+            imgsz=imgsz,
+            dynamic=True,
+            half=False,
+        )
+        exported = Path(exported)
+        if exported != target and exported.exists():
+            os.replace(exported, target)
+        print(f"Exported model cached at {target}")
+        return str(target)
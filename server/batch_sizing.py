@@ -0,0 +1,325 @@
+import gc
+import os
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+
+from metrics import REGISTRY, Gauge
+
+ADAPTIVE_BATCH_SIZE = REGISTRY.register(Gauge(
+    'heartscope_adaptive_batch_size',
+    'Batch size the adaptive batch controller currently runs',
+))
+
+# Sizes the controller steps through; denser than powers of two so it can
+# settle between them
+CANDIDATE_SIZES = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+_OOM_MESSAGES = ('out of memory', "can't allocate memory")
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """True for allocation failures from numpy, the CPU allocator, CUDA or MPS"""
+    if isinstance(error, MemoryError):
+        return True
+    cuda_oom = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if cuda_oom is not None and isinstance(error, cuda_oom):
+        return True
+    return isinstance(error, RuntimeError) and any(text in str(error).lower() for text in _OOM_MESSAGES)
+
+
+def release_memory(device: str):
+    gc.collect()
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+    elif device == 'mps':
+        torch.mps.empty_cache()
+
+
+def _status_bytes(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryProbe:
+    """Peak memory while one batch runs, on the device holding its working set.
+
+    CUDA reports a true allocator peak. On CPU the kernel's RSS high-water
+    mark is reset before each batch through /proc/self/clear_refs, falling
+    back to RSS after the batch where that is not allowed. MPS only exposes
+    current allocations, so it is sampled after the batch.
+    """
+
+    def __init__(self, device: str):
+        self.device = device
+        self._reset_hwm = device == 'cpu' and self._try_reset_hwm()
+
+    @staticmethod
+    def _try_reset_hwm() -> bool:
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    def start(self) -> Optional[int]:
+        """Reset the peak and return the bytes in use before the batch"""
+        if self.device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+            return torch.cuda.memory_allocated()
+        if self.device == 'mps':
+            return torch.mps.current_allocated_memory()
+        if self._reset_hwm:
+            self._try_reset_hwm()
+        return _status_bytes('VmRSS')
+
+    def peak(self) -> Optional[int]:
+        if self.device == 'cuda':
+            return torch.cuda.max_memory_allocated()
+        if self.device == 'mps':
+            return torch.mps.current_allocated_memory()
+        return _status_bytes('VmHWM' if self._reset_hwm else 'VmRSS')
+
+    def capacity(self) -> Optional[int]:
+        """Memory the device can hold, when it can be determined"""
+        if self.device == 'cuda':
+            return torch.cuda.mem_get_info()[1]
+        if self.device == 'mps' and hasattr(torch.mps, 'recommended_max_memory'):
+            return torch.mps.recommended_max_memory()
+        return None
+
+
+class AdaptiveBatchController:
+    """Picks the batch size with the best measured throughput under memory and latency ceilings.
+
+    Every batch run through ``run`` reports its wall time and peak memory.
+    The controller keeps smoothed figures per size, steps up to the next
+    candidate size while throughput keeps improving and the projected peak
+    stays under the memory ceiling, and settles on the smallest size within
+    a few percent of the best throughput seen. A batch over a ceiling caps the size below it; a
+    batch that runs out of memory is also retried at the next smaller
+    candidate size, so restricted (compiled) sizes are never left. Caps
+    and figures are dropped every ``reprobe_every`` batches so the
+    controller follows changes in load and input sizes.
+    """
+
+    def __init__(self, device: str, min_size: int = 1, max_size: int = 8,
+                 initial_size: Optional[int] = None, max_memory_bytes: Optional[int] = None,
+                 max_latency_ms: Optional[float] = None, samples: int = 3,
+                 reprobe_every: int = 200, smoothing: float = 0.3, tolerance: float = 0.03):
+        self.device = device
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_latency_ms = max_latency_ms
+        self.samples = max(1, samples)
+        self.reprobe_every = reprobe_every
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.probe = MemoryProbe(device)
+
+        self.candidates = self._candidates(CANDIDATE_SIZES + (self.max_size,))
+        self._cap = self.max_size
+        self._size = self._nearest(initial_size or self.min_size)
+        self._stats: Dict[int, Dict[str, float]] = {}
+        self._batches = 0
+        self.backoffs = 0
+        self._lock = threading.Lock()
+        ADAPTIVE_BATCH_SIZE.set(self._size)
+
+    @classmethod
+    def from_env(cls, device: str) -> Optional["AdaptiveBatchController"]:
+        """Build from ADAPTIVE_BATCH* settings, or None when ADAPTIVE_BATCH=0"""
+        if os.getenv('ADAPTIVE_BATCH', '1') == '0':
+            return None
+        controller = cls(
+            device,
+            min_size=int(os.getenv('ADAPTIVE_BATCH_MIN', '1')),
+            max_size=int(os.getenv('ADAPTIVE_BATCH_MAX', '8')),
+            # MPS used to be capped at 2, so start there and let measurements raise it
+            initial_size=int(os.getenv('ADAPTIVE_BATCH_INITIAL', '2' if device == 'mps' else '4')),
+            max_latency_ms=float(os.getenv('ADAPTIVE_BATCH_MAX_LATENCY_MS', '0')) or None,
+            samples=int(os.getenv('ADAPTIVE_BATCH_SAMPLES', '3')),
+            reprobe_every=int(os.getenv('ADAPTIVE_BATCH_REPROBE', '200')),
+        )
+        max_memory_mb = float(os.getenv('ADAPTIVE_BATCH_MAX_MEMORY_MB', '0'))
+        if max_memory_mb:
+            controller.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        else:
+            # Default to 90% of what the accelerator reports; no default ceiling on CPU
+            capacity = controller.probe.capacity()
+            controller.max_memory_bytes = int(capacity * 0.9) if capacity else None
+        return controller
+
+    def _candidates(self, sizes: Sequence[int]) -> List[int]:
+        candidates = sorted({size for size in sizes if self.min_size <= size <= self.max_size})
+        return candidates or [self.min_size]
+
+    def _nearest(self, size: int) -> int:
+        """Largest candidate at or below ``size`` and the cap, else the smallest candidate"""
+        limit = min(size, self._cap)
+        below = [c for c in self.candidates if c <= limit]
+        return below[-1] if below else self.candidates[0]
+
+    def restrict(self, sizes: Sequence[int]):
+        """Only choose among ``sizes``, e.g. the batch sizes a compiled graph was warmed for"""
+        with self._lock:
+            self.candidates = self._candidates(sizes)
+            # Never cap below every allowed size
+            self._cap = max(self._cap, self.candidates[0])
+            self._size = self._nearest(self._size)
+            ADAPTIVE_BATCH_SIZE.set(self._size)
+
+    @property
+    def batch_size(self) -> int:
+        return self._size
+
+    def run(self, count: int, process: Callable[[int, int], List[Any]]) -> List[Any]:
+        """Call ``process(start, end)`` over ``count`` items in controller-sized chunks.
+
+        A chunk that runs out of memory is retried at a smaller candidate
+        size; running out when no smaller candidate is left raises.
+        """
+        results: List[Any] = []
+        start = 0
+        while start < count:
+            size = min(self._size, count - start)
+            baseline = self.probe.start()
+            began = perf_counter()
+            try:
+                outputs = process(start, start + size)
+            except Exception as e:
+                if not is_out_of_memory(e) or not any(c < size for c in self.candidates):
+                    raise
+                print(f"Out of memory at batch size {size}, backing off: {e}")
+                oom = True
+            else:
+                oom = False
+
+            if oom:
+                # Outside the except block, so the traceback no longer pins the failed batch
+                release_memory(self.device)
+                self._backoff(size)
+                continue
+            self.record(size, perf_counter() - began, baseline, self.probe.peak())
+            results.extend(outputs)
+            start += size
+        return results
+
+    def _backoff(self, size: int):
+        with self._lock:
+            self.backoffs += 1
+            self._cap = max(self.min_size, min(self._cap, size - 1))
+            for larger in [s for s in self._stats if s >= size]:
+                del self._stats[larger]
+            # Next allowed size down; run() raised already if there is none
+            self._size = self._nearest(size - 1)
+            ADAPTIVE_BATCH_SIZE.set(self._size)
+
+    def record(self, size: int, seconds: float, baseline: Optional[int], peak: Optional[int]):
+        """Fold one batch's measurements into its size's figures and pick the next size"""
+        with self._lock:
+            stats = self._stats.setdefault(size, {'samples': 0})
+            blend = 1.0 if stats['samples'] == 0 else self.smoothing
+            update = {
+                'throughput': size / max(seconds, 1e-9),
+                'latency_ms': seconds * 1000,
+            }
+            if peak is not None:
+                update['peak_bytes'] = peak
+                if baseline is not None:
+                    update['baseline_bytes'] = baseline
+                    update['bytes_per_image'] = max(0, peak - baseline) / size
+            for key, value in update.items():
+                stats[key] = value if key not in stats else stats[key] + blend * (value - stats[key])
+            if peak is not None:
+                # Ceilings are checked against the worst peak, not the average
+                stats['max_peak_bytes'] = max(stats.get('max_peak_bytes', 0), peak)
+            stats['samples'] += 1
+
+            self._batches += 1
+            if self.reprobe_every and self._batches % self.reprobe_every == 0:
+                self._cap = self.max_size
+                self._stats = {self._size: self._stats[self._size]} if self._size in self._stats else {}
+            # Partial batches still inform the figures, only full ones steer
+            if size == self._size:
+                self._choose()
+
+    def _over_ceiling(self, stats: Dict[str, float]) -> bool:
+        if self.max_latency_ms and stats['latency_ms'] > self.max_latency_ms:
+            return True
+        return bool(self.max_memory_bytes) and stats.get('max_peak_bytes', 0) > self.max_memory_bytes
+
+    def _fits(self, size: int, reference: Dict[str, float]) -> bool:
+        """Whether ``size`` is projected to stay under the memory ceiling.
+
+        Memory scales roughly linearly per image, and overshooting it can
+        mean an OOM. Latency is not projected: a fixed per-batch cost makes
+        linear projections too pessimistic, and one slow batch is cheap.
+        """
+        if not self.max_memory_bytes or 'bytes_per_image' not in reference:
+            return True
+        return reference['baseline_bytes'] + reference['bytes_per_image'] * size <= self.max_memory_bytes
+
+    def _settled(self) -> Dict[int, Dict[str, float]]:
+        """Fully sampled sizes that are allowed and under the ceilings"""
+        return {
+            size: stats for size, stats in self._stats.items()
+            if size <= self._cap and size in self.candidates
+            and stats['samples'] >= self.samples and not self._over_ceiling(stats)
+        }
+
+    def _choose(self):
+        current = self._stats[self._size]
+        if self._over_ceiling(current):
+            smaller = [c for c in self.candidates if c < self._size]
+            self._cap = smaller[-1] if smaller else self.candidates[0]
+        elif current['samples'] >= self.samples:
+            # Keep growing only while each step up is still the fastest so far
+            fastest = max(stats['throughput'] for stats in self._settled().values())
+            larger = [c for c in self.candidates if self._size < c <= self._cap]
+            if (current['throughput'] >= fastest and larger and larger[0] not in self._stats
+                    and self._fits(larger[0], current)):
+                self._size = larger[0]
+                ADAPTIVE_BATCH_SIZE.set(self._size)
+                return
+        else:
+            return
+
+        settled = self._settled()
+        if settled:
+            best = max(stats['throughput'] for stats in settled.values())
+            # Prefer the smallest size that is nearly as fast: lower latency and memory
+            self._size = min(size for size, stats in settled.items()
+                             if stats['throughput'] >= best * (1 - self.tolerance))
+        else:
+            self._size = self._nearest(self._cap)
+        ADAPTIVE_BATCH_SIZE.set(self._size)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "batch_size": self._size,
+                "cap": self._cap,
+                "candidates": list(self.candidates),
+                "max_memory_mb": round(self.max_memory_bytes / 2**20, 1) if self.max_memory_bytes else None,
+                "max_latency_ms": self.max_latency_ms,
+                "backoffs": self.backoffs,
+                "sizes": {
+                    size: {
+                        "samples": int(stats['samples']),
+                        "images_per_second": round(stats['throughput'], 2),
+                        "latency_ms": round(stats['latency_ms'], 1),
+                        "peak_mb": round(stats['max_peak_bytes'] / 2**20, 1) if 'max_peak_bytes' in stats else None,
+                    }
+                    for size, stats in sorted(self._stats.items())
+                },
+            }
@@ -0,0 +1,153 @@
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from metrics import REGISTRY, Gauge
+
+BATCH_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'heartscope_batch_queue_depth',
+    'Images waiting for the micro-batcher to open a batch',
+))
+
+
+class MicroBatcher:
+    """Collect images from concurrent requests into shared inference batches.
+
+    Callers submit single images and get a Future back. A background thread
+    drains the queue into batches bounded by ``max_batch_size`` and
+    ``max_wait_ms`` and hands each batch to ``model.process_batch``, so
+    images from different in-flight requests share one forward pass.
+
+    When an ``executor`` is given, batches run on it instead of the batching
+    thread. At most ``max_concurrent_batches`` are in flight; while they run,
+    new images keep queueing so the next batch is full when a slot frees up.
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, max_wait_ms: float = 10.0,
+                 executor: Optional[Executor] = None, max_concurrent_batches: int = 1):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.executor = executor
+        self._slots = threading.Semaphore(max(1, max_concurrent_batches))
+
+        # (image, future, enhancement mode or None for the model default)
+        self._queue: "queue.Queue[Optional[Tuple[np.ndarray, Future, Optional[str]]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self):
+        """Start the background batching thread"""
+        if self._thread is not None:
+            return
+        self._stopped = False
+        BATCH_QUEUE_DEPTH.set_function(self.queue_depth)
+        self._thread = threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the batching thread, failing anything still queued"""
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("Batcher stopped"))
+
+    def queue_depth(self) -> int:
+        """Images submitted but not yet collected into a batch"""
+        return self._queue.qsize()
+
+    def submit(self, image: np.ndarray, enhance: Optional[str] = None) -> Future:
+        """Queue a single image and return a Future for its annotations"""
+        if self._thread is None or self._stopped:
+            raise RuntimeError("Batcher is not running")
+        future: Future = Future()
+        self._queue.put((image, future, enhance))
+        return future
+
+    def _collect(self, first: Tuple[np.ndarray, Future, Optional[str]]) -> Tuple[List[Tuple[np.ndarray, Future, Optional[str]]], bool]:
+        """Gather items until the batch is full or the wait window closes"""
+        batch = [first]
+        deadline = perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        while True:
+            # Wait for a free inference slot before opening the next batch
+            self._slots.acquire()
+            item = self._queue.get()
+            if item is None:
+                self._slots.release()
+                return
+            batch, stopping = self._collect(item)
+
+            if self.executor is None:
+                try:
+                    self._dispatch(batch)
+                finally:
+                    self._slots.release()
+            else:
+                try:
+                    done = self.executor.submit(self._dispatch, batch)
+                except RuntimeError as e:
+                    # Executor already shut down
+                    self._slots.release()
+                    for _, fut, _ in batch:
+                        if fut.set_running_or_notify_cancel():
+                            fut.set_exception(e)
+                    return
+                done.add_done_callback(lambda _: self._slots.release())
+
+            if stopping:
+                return
+
+    def _dispatch(self, batch: List[Tuple[np.ndarray, Future, Optional[str]]]):
+        """Run one collected batch and resolve each caller's Future"""
+        # Drop requests whose callers have already gone away
+        live = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not live:
+            return
+
+        # process_batch letterboxes inputs, so mixed sizes and enhancement
+        # modes share one pass. Failures raise rather than coming back as
+        # empty results, so callers can tell them from "no detections".
+        images = [img for img, _, _ in live]
+        modes = [mode for _, _, mode in live]
+        try:
+            if any(mode is not None for mode in modes):
+                results = self.model.process_batch(
+                    images, batch_size=len(images), enhance=modes, raise_errors=True)
+            else:
+                results = self.model.process_batch(images, batch_size=len(images), raise_errors=True)
+        except Exception as e:
+            for _, fut, _ in live:
+                fut.set_exception(e)
+            return
+
+        for (_, fut, _), result in zip(live, results):
+            fut.set_result(result)
@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+SUITES = ('inference', 'batch', 'pdf', 'server', 'preprocess')
+
+# Lower is better for latencies, higher is better for throughput
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'mean_ms')
+HIGHER_IS_BETTER = ('images_per_s', 'pages_per_s')
+
+
+def summarize(samples_ms: List[float]) -> Dict[str, float]:
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        'mean_ms': float(samples.mean()),
+        'min_ms': float(samples.min()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'samples': len(samples),
+    }
+
+
+def max_rss_mb() -> float:
+    """Peak resident memory of this process so far (Linux reports KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_calls(fn: Callable[[], Any], repeats: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeats):
+        start = perf_counter()
+        fn()
+        samples.append((perf_counter() - start) * 1000)
+    return samples
+
+
+def synthetic_image(size: int, seed: int = 0) -> np.ndarray:
+    """ECG-like RGB test image: grid paper with a few noisy traces"""
+    rng = np.random.default_rng(seed)
+    height, width = size, int(size * 1.4)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    step = max(4, size // 50)
+    image[::step, :] = (255, 200, 200)
+    image[:, ::step] = (255, 200, 200)
+
+    xs = np.arange(0, width, 2)
+    for row in range(4):
+        baseline = (row + 0.5) * height / 4
+        ys = baseline + np.cumsum(rng.normal(0, size / 400, len(xs)))
+        ys += (rng.random(len(xs)) > 0.98) * -size / 12
+        points = np.stack([xs, np.clip(ys, 0, height - 1)], axis=1).astype(np.int32)
+        cv2.polylines(image, [points], False, (0, 0, 0), max(1, size // 500))
+    return image
+
+
+def load_fixture_images(directory: Optional[str], limit: int) -> List[np.ndarray]:
+    if not directory:
+        return []
+    images = []
+    for path in sorted(Path(directory).glob("**/*")):
+        if path.suffix.lower() not in ('.png', '.jpg', '.jpeg'):
+            continue
+        image = cv2.imread(str(path))
+        if image is not None:
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if len(images) >= limit:
+            break
+    return images
+
+
+def synthetic_pdf(path: Path, pages: int, size: int = 1024):
+    from PIL import Image
+
+    frames = [Image.fromarray(synthetic_image(size, seed=page)) for page in range(pages)]
+    frames[0].save(str(path), 'PDF', save_all=True, append_images=frames[1:], resolution=150)
+
+
+def standin_weights(directory: Path) -> str:
+    """Build an untrained nano segmentation model so runs work without real weights"""
+    from ultralytics import YOLO
+
+    path = directory / "standin-seg.pt"
+    if not path.exists():
+        print("Weights not found, using an untrained yolov8n-seg stand-in")
+        YOLO("yolov8n-seg.yaml").save(str(path))
+    return str(path)
+
+
+def bench_inference(weights: str, image_sizes: List[int], repeats: int,
+                    fixtures: List[np.ndarray]) -> List[Dict[str, Any]]:
+    """YOLOInference.get_annotations, one image at a time"""
+    from inference import YOLOInference, get_inferencer
+
+    inferencer = get_inferencer(weights, cls=YOLOInference)
+    results = []
+    for size in image_sizes:
+        image = synthetic_image(size)
+        samples = time_calls(lambda: inferencer.get_annotations(image), repeats)
+        results.append({'suite': 'inference', 'params': {'image_size': size, 'source': 'synthetic'},
+                        'metrics': summarize(samples)})
+    for index, image in enumerate(fixtures):
+        samples = time_calls(lambda: inferencer.get_annotations(image), repeats)
+        results.append({'suite': 'inference', 'params': {'image_size': max(image.shape[:2]), 'source': f'fixture-{index}'},
+                        'metrics': summarize(samples)})
+    return results
+
+
+def bench_batch(inferencer, batch_sizes: List[int], image_sizes: List[int],
+                repeats: int) -> List[Dict[str, Any]]:
+    """OptimizedYOLOInference.process_batch across batch and image sizes"""
+    results = []
+    for size in image_sizes:
+        for batch_size in batch_sizes:
+            images = [synthetic_image(size, seed=i) for i in range(batch_size)]
+            samples = time_calls(lambda: inferencer.process_batch(images, batch_size=batch_size), repeats)
+            metrics = summarize(samples)
+            metrics['images_per_s'] = batch_size * 1000 / metrics['mean_ms']
+            results.append({'suite': 'batch', 'params': {'image_size': size, 'batch_size': batch_size},
+                            'metrics': metrics})
+    return results
+
+
+def bench_preprocess(inferencer, image_sizes: List[int], repeats: int,
+                     fixtures: List[np.ndarray]) -> List[Dict[str, Any]]:
+    """OptimizedYOLOInference.preprocess_image for every enhancement mode"""
+    from enhancement import ENHANCE_MODES
+
+    inputs = [(size, 'synthetic', synthetic_image(size)) for size in image_sizes]
+    inputs += [(max(image.shape[:2]), f'fixture-{index}', image) for index, image in enumerate(fixtures)]
+    results = []
+    for size, source, image in inputs:
+        for mode in ENHANCE_MODES:
+            samples = time_calls(lambda: inferencer.preprocess_image(image, enhance=mode), repeats)
+            results.append({'suite': 'preprocess', 'params': {'image_size': size, 'source': source, 'enhance': mode},
+                            'metrics': summarize(samples)})
+    return results
+
+
+def bench_pdf(inferencer, pdf_path: Optional[str], pages: int, workdir: Path) -> List[Dict[str, Any]]:
+    """OptimizedYOLOInference.process_pdf on a fixture or synthetic document"""
+    if not pdf_path:
+        pdf_path = str(workdir / f"synthetic-{pages}.pdf")
+        synthetic_pdf(Path(pdf_path), pages)
+
+    start = perf_counter()
+    annotations = inferencer.process_pdf(Path(pdf_path))
+    elapsed = perf_counter() - start
+    return [{
+        'suite': 'pdf',
+        'params': {'pages': len(annotations), 'source': Path(pdf_path).name},
+        'metrics': {'total_ms': elapsed * 1000, 'pages_per_s': len(annotations) / elapsed,
+                    'max_rss_mb': max_rss_mb()},
+    }]
+
+
+async def _post_analyze(client, payload: bytes, filename: str) -> float:
+    start = perf_counter()
+    response = await client.post('/analyze', files=[('files', (filename, payload, 'image/png'))])
+    response.raise_for_status()
+    return (perf_counter() - start) * 1000
+
+
+async def _bench_server(concurrency_levels: List[int], image_sizes: List[int],
+                        requests_per_level: int) -> List[Dict[str, Any]]:
+    import httpx
+    import server
+
+    results = []
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for size in image_sizes:
+            ok, encoded = cv2.imencode('.png', cv2.cvtColor(synthetic_image(size), cv2.COLOR_RGB2BGR))
+            payload = encoded.tobytes()
+            await _post_analyze(client, payload, "warmup.png")
+
+            for concurrency in concurrency_levels:
+                samples: List[float] = []
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def one(index: int):
+                    async with semaphore:
+                        # Unique bytes per request so the result cache can't short-circuit
+                        body = payload + index.to_bytes(4, 'little')
+                        samples.append(await _post_analyze(client, body, f"bench-{index}.png"))
+
+                start = perf_counter()
+                await asyncio.gather(*(one(i) for i in range(requests_per_level)))
+                elapsed = perf_counter() - start
+
+                metrics = summarize(samples)
+                metrics['images_per_s'] = requests_per_level / elapsed
+                results.append({'suite': 'server',
+                                'params': {'image_size': size, 'concurrency': concurrency},
+                                'metrics': metrics})
+    return results
+
+
+def bench_server(weights: str, concurrency_levels: List[int], image_sizes: List[int],
+                 requests_per_level: int) -> List[Dict[str, Any]]:
+    """/analyze end to end through the ASGI app, in-process"""
+    import inference
+    import server
+
+    os.environ['YOLO_WEIGHTS_PATH'] = weights
+    os.environ.setdefault('DEBUG_PRINT', '0')
+    server.DEBUG_PRINT = inference.DEBUG_PRINT = os.environ['DEBUG_PRINT'] != '0'
+    if not server.init_model():
+        raise RuntimeError("Failed to initialize model for server benchmark")
+    server.warmup_model()
+    try:
+        return asyncio.run(_bench_server(concurrency_levels, image_sizes, requests_per_level))
+    finally:
+        server.batcher.stop()
+        server.pools.shutdown()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(weights: str, standin: bool) -> Dict[str, Any]:
+    import torch
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'weights': weights,
+        'standin_model': standin,
+        'backend': os.getenv('YOLO_BACKEND', 'torch'),
+        'cpu_precision': os.getenv('CPU_PRECISION', 'fp32'),
+    }
+
+
+def _result_key(entry: Dict[str, Any]) -> str:
+    return entry['suite'] + ':' + json.dumps(entry['params'], sort_keys=True)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[str]:
+    """List metrics that regressed by more than ``tolerance`` against a baseline run"""
+    previous = {_result_key(entry): entry['metrics'] for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in current['results']:
+        old = previous.get(_result_key(entry))
+        if old is None:
+            continue
+        for metric, value in entry['metrics'].items():
+            if metric not in old or not old[metric]:
+                continue
+            change = (value - old[metric]) / old[metric]
+            if (metric in LOWER_IS_BETTER and change > tolerance) or \
+                    (metric in HIGHER_IS_BETTER and -change > tolerance):
+                regressions.append(f"{_result_key(entry)} {metric}: {old[metric]:.2f} -> {value:.2f} ({change:+.1%})")
+    return regressions
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inference and serving paths")
+    parser.add_argument('--weights', default=os.getenv('YOLO_WEIGHTS_PATH', "models/segment-2.pt"))
+    parser.add_argument('--suites', default=','.join(SUITES), help=f"Comma separated: {', '.join(SUITES)}")
+    parser.add_argument('--batch-sizes', type=_int_list, default=[1, 2, 4, 8])
+    parser.add_argument('--image-sizes', type=_int_list, default=[512, 1024, 2048])
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4, 8])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=16, help="Requests per concurrency level")
+    parser.add_argument('--images', help="Directory of fixture images")
+    parser.add_argument('--fixture-limit', type=int, default=4)
+    parser.add_argument('--pdf', help="Fixture PDF (a synthetic one is generated otherwise)")
+    parser.add_argument('--pdf-pages', type=int, default=8)
+    parser.add_argument('--no-compile', action='store_true', help="Skip torch.compile during warmup")
+    parser.add_argument('--adaptive-batch', action='store_true',
+                        help="Let the adaptive batch controller re-chunk batches (off, so sizes run as given)")
+    parser.add_argument('--output', default="bench_results.json")
+    parser.add_argument('--baseline', help="Previous results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    if args.no_compile:
+        os.environ['TORCH_COMPILE'] = '0'
+    os.environ['ADAPTIVE_BATCH'] = '1' if args.adaptive_batch else '0'
+    suites = [suite.strip() for suite in args.suites.split(',') if suite.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"Unknown suites: {', '.join(sorted(unknown))}")
+
+    from inference import get_inferencer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        standin = not Path(args.weights).exists()
+        weights = standin_weights(workdir) if standin else args.weights
+
+        fixtures = load_fixture_images(args.images, args.fixture_limit)
+        results: List[Dict[str, Any]] = []
+
+        if 'inference' in suites:
+            results.extend(bench_inference(weights, args.image_sizes, args.repeats, fixtures))
+
+        if 'batch' in suites or 'pdf' in suites:
+            optimized = get_inferencer(weights)
+            optimized.warmup(args.batch_sizes)
+            if 'batch' in suites:
+                results.extend(bench_batch(optimized, args.batch_sizes, args.image_sizes, args.repeats))
+            if 'pdf' in suites:
+                try:
+                    results.extend(bench_pdf(optimized, args.pdf, args.pdf_pages, workdir))
+                except Exception as e:
+                    # pdf2image needs poppler installed
+                    print(f"Skipping PDF benchmark: {e}")
+
+        if 'preprocess' in suites:
+            results.extend(bench_preprocess(get_inferencer(weights), args.image_sizes, args.repeats, fixtures))
+
+        if 'server' in suites:
+            results.extend(bench_server(weights, args.concurrency, args.image_sizes, args.requests))
+
+        report = {'meta': metadata(weights, standin), 'results': results}
+        report['meta']['max_rss_mb'] = max_rss_mb()
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        regressions = compare(json.loads(Path(args.baseline).read_text()), report, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+# Statuses that mean a file needs no further work
+DONE_STATUSES = ('ok', 'empty')
+
+# (path relative to the input root, size, mtime_ns)
+Entry = Tuple[str, int, int]
+
+
+def iter_images(root: Path, exclude: Optional[Path] = None) -> Iterator[Entry]:
+    """Walk ``root`` lazily in a stable order, yielding image files as they are found"""
+    exclude = exclude.resolve() if exclude is not None else None
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Never annotate our own outputs when they are written inside the input tree
+        dirnames[:] = sorted(name for name in dirnames if (Path(dirpath) / name).resolve() != exclude)
+        for name in sorted(filenames):
+            if not name.lower().endswith(IMAGE_SUFFIXES):
+                continue
+            path = Path(dirpath) / name
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield path.relative_to(root).as_posix(), stat.st_size, stat.st_mtime_ns
+
+
+class Manifest:
+    """Append-only JSON lines record of processed files.
+
+    Each line is written after the file's outputs, so every file marked done
+    has its outputs on disk. A file counts as done only while its size and
+    mtime still match, so edited inputs are annotated again. Failed files are
+    retried on the next run.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write leaves a torn last line
+                        continue
+                    self.entries[record['path']] = record
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, 'a')
+
+    def is_done(self, entry: Entry) -> bool:
+        record = self.entries.get(entry[0])
+        return (record is not None and record['status'] in DONE_STATUSES
+                and record['size'] == entry[1] and record['mtime_ns'] == entry[2])
+
+    def record(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self._file.write(json.dumps(record) + '\n')
+            self.entries[record['path']] = record
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _annotate_batch(inferencer, visualizer, batch: List[Entry], input_dir: Path, output_dir: Path,
+                    options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Decode, annotate and write one batch; returns one manifest record per file"""
+    from mask_encoding import to_json_ready
+
+    records, ready, images = [], [], []
+    for rel, size, mtime_ns in batch:
+        record = {'path': rel, 'size': size, 'mtime_ns': mtime_ns}
+        image = cv2.imread(str(input_dir / rel))
+        if image is None:
+            records.append({**record, 'status': 'error', 'error': "Failed to read image"})
+            continue
+        ready.append(record)
+        images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+    if not images:
+        return records
+    try:
+        # Raise rather than return {}: an empty result would be recorded as
+        # done and never retried
+        results = inferencer.process_batch(images, batch_size=len(images),
+                                           enhance=[options['enhance']] * len(images), raise_errors=True)
+    except Exception as e:
+        return records + [{**record, 'status': 'error', 'error': str(e)} for record in ready]
+
+    for record, image, annotations in zip(ready, images, results):
+        try:
+            rel = Path(record['path'])
+            target = output_dir / rel.parent
+            target.mkdir(parents=True, exist_ok=True)
+            detections = len(annotations.get('boxes', ())) if annotations else 0
+            outputs = []
+            if options['visualize'] and detections:
+                output_path = target / f"{rel.stem}_pred{rel.suffix}"
+                visualized = visualizer.plot_boxes_and_masks(image, annotations)
+                cv2.imwrite(str(output_path), cv2.cvtColor(visualized, cv2.COLOR_RGB2BGR))
+                outputs.append(output_path.relative_to(output_dir).as_posix())
+            if options['save_json']:
+                output_path = target / f"{rel.stem}.json"
+                formatted = to_json_ready(annotations, options['mask_format'], True)
+                output_path.write_text(json.dumps(formatted))
+                outputs.append(output_path.relative_to(output_dir).as_posix())
+            records.append({**record, 'status': 'ok' if detections else 'empty',
+                            'detections': detections, 'outputs': outputs})
+        except Exception as e:
+            records.append({**record, 'status': 'error', 'error': str(e)})
+    return records
+
+
+def _worker_main(index: int, model_path: str, backend: Optional[str], cores: List[int],
+                 weights_path: Optional[str], batch_size: int, input_dir: str, output_dir: str,
+                 options: Dict[str, Any], tasks, results):
+    """Worker process: load the model once, then annotate batches until it receives None"""
+    import torch
+
+    # Ctrl-C reaches the whole process group; the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(max(1, len(cores)))
+    if weights_path:
+        os.environ['SHARED_WEIGHTS_PATH'] = weights_path
+    if options['enhance']:
+        # Load the graph the parent exported: INT8 models are calibrated per mode
+        os.environ['ENHANCE_MODE'] = options['enhance']
+
+    from annotate import YOLOVisualizer
+    from inference import get_inferencer
+
+    try:
+        inferencer = get_inferencer(model_path, backend=backend)
+        # Every size up to the batch, so the batch controller can back off on OOM
+        inferencer.warmup(list(range(1, batch_size + 1)))
+    except Exception as e:
+        results.put(('failed', index, f"{type(e).__name__}: {e}"))
+        return
+    visualizer = YOLOVisualizer(inferencer=inferencer)
+    results.put(('ready', index, str(inferencer.device)))
+
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            break
+        results.put(('batch', index, _annotate_batch(
+            inferencer, visualizer, batch, Path(input_dir), Path(output_dir), options)))
+    results.put(('exit', index, None))
+
+
+def _feed(entries: Iterator[Entry], manifest: Manifest, tasks, workers: int, batch_size: int,
+          stop: threading.Event, counts: Dict[str, int]):
+    """Stream unfinished files to the workers in batches; the bounded queue throttles the walk"""
+    batch: List[Entry] = []
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                tasks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    for entry in entries:
+        if stop.is_set():
+            return
+        if manifest.is_done(entry):
+            counts['skipped'] += 1
+            continue
+        counts['queued'] += 1
+        batch.append(entry)
+        if len(batch) == batch_size:
+            if not put(batch):
+                return
+            batch = []
+    if batch and not put(batch):
+        return
+    counts['walked'] = 1
+    for _ in range(workers):
+        put(None)
+
+
+def run(input_dir: Path, output_dir: Path, model_path: str, workers: int = 0, batch_size: int = 8,
+        manifest_path: Optional[Path] = None, backend: Optional[str] = None, enhance: Optional[str] = None,
+        visualize: bool = True, save_json: bool = False, mask_format: str = 'rle',
+        force: bool = False, progress_interval: float = 10.0) -> Dict[str, int]:
+    """Annotate every image under ``input_dir``, resuming from the manifest; returns counts"""
+    from backends import get_backend
+    from enhancement import get_enhance_mode
+    from inference import export_for_workers, export_shared_weights, get_device
+    from process_pool import core_subsets
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = manifest_path or output_dir / 'manifest.jsonl'
+    if force and manifest_path.exists():
+        manifest_path.unlink()
+    manifest = Manifest(manifest_path)
+
+    backend = get_backend(backend)
+    device = get_device() if backend == 'torch' else 'cpu'
+    on_cpu = backend == 'torch' and device == 'cpu'
+    if workers <= 0:
+        # One process per accelerator; on CPU, a few processes with their own cores
+        workers = max(1, min(4, (os.cpu_count() or 1) // 4)) if on_cpu else 1
+    weights_path = export_shared_weights(model_path) if on_cpu and workers > 1 else None
+    if workers > 1:
+        # Workers would otherwise export or quantize the same graph concurrently;
+        # they serve --enhance as their ENHANCE_MODE, so this is the graph they load
+        export_for_workers(model_path, backend, enhance)
+    subsets = core_subsets(workers) if on_cpu else [[] for _ in range(workers)]
+    options = {
+        'enhance': get_enhance_mode(enhance) if enhance else None,
+        'visualize': visualize,
+        'save_json': save_json,
+        'mask_format': mask_format,
+    }
+
+    # Spawn, not fork: the parent may already hold torch thread pools or CUDA state
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue(maxsize=workers * 2)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_worker_main,
+            args=(index, model_path, backend, subsets[index], weights_path, batch_size,
+                  str(input_dir), str(output_dir), options, tasks, results),
+            name=f"annotate-{index}",
+            daemon=True,
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    counts = {'queued': 0, 'skipped': 0, 'ok': 0, 'empty': 0, 'error': 0, 'walked': 0}
+    stop = threading.Event()
+    feeder = threading.Thread(
+        target=_feed,
+        args=(iter_images(input_dir, exclude=output_dir), manifest, tasks, workers, batch_size, stop, counts),
+        name="annotate-feeder", daemon=True,
+    )
+    feeder.start()
+
+    running = set(range(workers))
+    start = last_report = time.perf_counter()
+    try:
+        while running:
+            try:
+                kind, index, payload = results.get(timeout=1.0)
+            except queue.Empty:
+                for index in list(running):
+                    if not processes[index].is_alive():
+                        print(f"Annotation worker {index} exited unexpectedly; its batch will be retried on the next run")
+                        running.discard(index)
+                if not running:
+                    break
+                continue
+
+            if kind == 'ready':
+                print(f"Annotation worker {index} ready on {payload} (cores {subsets[index] or 'all'})")
+            elif kind == 'failed':
+                print(f"Annotation worker {index} failed to start: {payload}")
+                running.discard(index)
+            elif kind == 'exit':
+                running.discard(index)
+            elif kind == 'batch':
+                manifest.record(payload)
+                for record in payload:
+                    counts[record['status']] += 1
+                    if record['status'] == 'error':
+                        print(f"Error processing {record['path']}: {record['error']}")
+
+            now = time.perf_counter()
+            if now - last_report >= progress_interval:
+                last_report = now
+                done = counts['ok'] + counts['empty'] + counts['error']
+                print(f"Annotated {done}/{counts['queued']} queued "
+                      f"({counts['skipped']} already done, {counts['error']} errors), "
+                      f"{done / (now - start):.1f} images/s")
+    except KeyboardInterrupt:
+        print("Interrupted; rerun the same command to resume")
+    finally:
+        stop.set()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(5)
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    done = counts['ok'] + counts['empty'] + counts['error']
+    counts['remaining'] = counts['queued'] - done
+    finished = counts['walked'] and not counts['remaining']
+    print(f"Annotated {done} images in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} images/s): "
+          f"{counts['ok']} with detections, {counts['empty']} without, {counts['error']} errors, "
+          f"{counts['skipped']} skipped from the manifest"
+          + ("" if finished else f", {counts['remaining']} queued files"
+             + ("" if counts['walked'] else " and the unwalked rest of the tree") + " left for the next run"))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Annotate a directory tree of images; interrupted runs resume from the manifest")
+    parser.add_argument('input_dir', type=Path)
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('--weights', default=os.getenv('YOLO_WEIGHTS_PATH', "models/segment-2.pt"))
+    parser.add_argument('--backend', default=None, help="Inference backend (defaults to YOLO_BACKEND)")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('ANNOTATE_WORKERS', '0')),
+                        help="Worker processes, each loading the model once (0 picks from the device)")
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv('ANNOTATE_BATCH_SIZE', '8')))
+    parser.add_argument('--manifest', type=Path, help="Defaults to OUTPUT_DIR/manifest.jsonl")
+    parser.add_argument('--enhance', help="Enhancement mode (defaults to ENHANCE_MODE)")
+    parser.add_argument('--json', action='store_true', help="Also write annotations as JSON next to each image")
+    parser.add_argument('--mask-format', default='rle', choices=('raw', 'rle', 'png'))
+    parser.add_argument('--no-visualize', action='store_true', help="Skip writing *_pred images")
+    parser.add_argument('--force', action='store_true', help="Ignore the manifest and annotate everything")
+    args = parser.parse_args()
+
+    if not args.input_dir.is_dir():
+        parser.error(f"Input directory not found: {args.input_dir}")
+    if args.no_visualize and not args.json:
+        parser.error("Nothing to write: pass --json or drop --no-visualize")
+
+    counts = run(
+        args.input_dir, args.output_dir, args.weights,
+        workers=args.workers, batch_size=max(1, args.batch_size), manifest_path=args.manifest,
+        backend=args.backend, enhance=args.enhance, visualize=not args.no_visualize,
+        save_json=args.json, mask_format=args.mask_format, force=args.force,
+    )
+    sys.exit(0 if counts['walked'] and not counts['remaining'] and not counts['error'] else 1)
+
+
+if __name__ == "__main__":
+    main()
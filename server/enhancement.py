@@ -0,0 +1,78 @@
+import os
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# '<filter>' enhances at the smaller of source and model resolution, with
+# kernels scaled to match; '<filter>-full' keeps the original behaviour of
+# enhancing at full source resolution and resizing afterwards.
+ENHANCE_MODES = ('bilateral', 'bilateral-full', 'threshold', 'threshold-full', 'none')
+
+
+def get_enhance_mode(mode: Optional[str] = None, default: Optional[str] = None) -> str:
+    """Resolve an enhancement mode, falling back to ``default`` and then ENHANCE_MODE"""
+    mode = (mode or default or os.getenv('ENHANCE_MODE', 'bilateral')).lower()
+    if mode not in ENHANCE_MODES:
+        raise ValueError(f"Unknown enhance mode '{mode}', expected one of {', '.join(ENHANCE_MODES)}")
+    return mode
+
+
+def to_rgb_uint8(image) -> np.ndarray:
+    """Normalize numpy or PIL input to a 3-channel uint8 array"""
+    if not isinstance(image, np.ndarray):
+        image = np.array(image)
+    if image.dtype != np.uint8:
+        image = (image * 255).astype(np.uint8)
+    if image.ndim == 2 or (image.ndim == 3 and image.shape[2] == 1):
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    return image
+
+
+def _odd(value: float, minimum: int = 3) -> int:
+    return max(minimum, int(round(value)) | 1)
+
+
+def bilateral_filter(image: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """Edge-preserving smoothing; a 9px diameter at source resolution"""
+    return cv2.bilateralFilter(image, _odd(9 * scale), 75, 75 * scale)
+
+
+def threshold_filter(image: np.ndarray, scale: float = 1.0, fast: bool = False) -> np.ndarray:
+    """Adaptive binarization plus denoising, returned as RGB"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    thresh = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY, _odd(11 * scale), 2
+    )
+    # On a binary image a median removes the same speckle as non-local
+    # means at a fraction of the cost
+    denoised = cv2.medianBlur(thresh, 3) if fast else cv2.fastNlMeansDenoising(thresh)
+    return cv2.cvtColor(denoised, cv2.COLOR_GRAY2RGB)
+
+
+def _apply(image: np.ndarray, mode: str, scale: float) -> np.ndarray:
+    if mode.startswith('bilateral'):
+        return bilateral_filter(image, scale)
+    return threshold_filter(image, scale, fast=not mode.endswith('-full'))
+
+
+def enhance_and_resize(image, size: Tuple[int, int], mode: str = 'bilateral',
+                       interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+    """Enhance an image and resize it to ``size`` (width, height).
+
+    Resolution-aware modes shrink before filtering, so the filter cost
+    follows the model input size instead of the source size.
+    """
+    image = to_rgb_uint8(image)
+    height, width = image.shape[:2]
+    if mode == 'none':
+        return cv2.resize(image, size, interpolation=interpolation)
+    if mode.endswith('-full'):
+        return cv2.resize(_apply(image, mode, 1.0), size, interpolation=interpolation)
+
+    scale = min(size[0] / width, size[1] / height)
+    if scale < 1:
+        # Area averaging anti-aliases the downscale before the filter sees it
+        return _apply(cv2.resize(image, size, interpolation=cv2.INTER_AREA), mode, scale)
+    return cv2.resize(_apply(image, mode, 1.0), size, interpolation=interpolation)
@@ -1,9 +1,12 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+import gc
 import os
+import tempfile
+import threading
 from time import perf_counter
-from functools import partial
+from functools import partial, wraps
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type
 
 import cv2
 import numpy as np
@@ -11,6 +14,18 @@ import pdf2image
 import torch
 from ultralytics import YOLO
 
+from backends import export_weights, get_backend
+from batch_sizing import AdaptiveBatchController, is_out_of_memory
+from enhancement import bilateral_filter, enhance_and_resize, get_enhance_mode, threshold_filter, to_rgb_uint8
+from metrics import stage_timer
+from postprocess import image_hw, scale_to_original
+from quantization import agreement, find_images, read_rgb
+from tiling import Tile, merge_tile_detections, tile_detections, tile_grid
+
+
+# Per-batch progress and timing output, silenced by DEBUG_PRINT=0 like the server's
+DEBUG_PRINT = os.getenv('DEBUG_PRINT', '1') != '0'
+
 
 def get_device() -> str:
     if torch.cuda.is_available():
@@ -20,15 +35,205 @@ def get_device() -> str:
     return 'cpu'
 
 
+def _completed(value: Any) -> Future:
+    """Wrap an already computed value in a resolved Future"""
+    future: Future = Future()
+    future.set_result(value)
+    return future
+
+
+def configure_compile_cache(cache_dir: str):
+    """Persist torch.compile / Inductor caches under ``cache_dir`` across restarts"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+    # Newer torch can also restore compiled artifacts in one blob
+    artifacts = Path(cache_dir) / 'compile_artifacts.bin'
+    if artifacts.exists() and hasattr(torch.compiler, 'load_cache_artifacts'):
+        try:
+            torch.compiler.load_cache_artifacts(artifacts.read_bytes())
+            print(f"Loaded compile cache from {artifacts}")
+        except Exception as e:
+            print(f"Ignoring unusable compile cache {artifacts}: {e}")
+
+
+def save_compile_cache(cache_dir: str):
+    """Write compiled artifacts so the next process can skip recompiling"""
+    if not hasattr(torch.compiler, 'save_cache_artifacts'):
+        return
+    try:
+        saved = torch.compiler.save_cache_artifacts()
+        if saved:
+            artifacts = Path(cache_dir) / 'compile_artifacts.bin'
+            artifacts.write_bytes(saved[0])
+            print(f"Saved compile cache to {artifacts}")
+    except Exception as e:
+        print(f"Error saving compile cache: {e}")
+
+
+# bf16 must stay this close to float32 on the head's raw outputs: class
+# scores in probability units, box coordinates in letterbox pixels
+BF16_MAX_SCORE_ERROR = 0.05
+BF16_MAX_BOX_ERROR = 2.0
+
+
+def _to_float32(value: Any) -> Any:
+    """Cast floating tensors inside nested network inputs or outputs to float32"""
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.is_floating_point() else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_float32(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _to_float32(item) for key, item in value.items()}
+    return value
+
+
+def _autocast_forward(forward, enabled: bool):
+    """Wrap a bound forward to run with CPU bf16 autocast on or off, returning float32"""
+    @wraps(forward)
+    def run(*args, **kwargs):
+        if not enabled:
+            args = _to_float32(args)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled):
+            return _to_float32(forward(*args, **kwargs))
+    return run
+
+
+def _timed_forward(network: torch.nn.Module, batch: torch.Tensor, repeats: int = 2) -> Tuple[torch.Tensor, float]:
+    """Decoded head output (boxes, class scores, ...) of a warmed network and its best forward time in ms"""
+    with torch.inference_mode():
+        output = network(batch)
+        best = float('inf')
+        for _ in range(repeats):
+            start = perf_counter()
+            network(batch)
+            best = min(best, (perf_counter() - start) * 1000)
+    # The decoded predictions lead the output, however deeply ultralytics nests them
+    while isinstance(output, (list, tuple)):
+        output = output[0]
+    return output, best
+
+
+def export_shared_weights(model_path: str, shared_dir: Optional[str] = None) -> str:
+    """Write fused float32 weights once so worker processes can memory-map a single copy
+
+    Defaults to /dev/shm, where the file's pages are the shared memory itself.
+    """
+    shared_dir = shared_dir or os.getenv('SHARED_WEIGHTS_DIR') or (
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+    source = Path(model_path)
+    stat = source.stat()
+    target = Path(shared_dir) / f"heartscope-{source.stem}-{int(stat.st_mtime)}-{stat.st_size}.fused.pt"
+    if target.exists():
+        return str(target)
+
+    print(f"Writing shared weights for {source} to {target}")
+    model = YOLO(str(source))
+    model.fuse()
+    partial_path = target.with_suffix('.partial')
+    torch.save(model.model.float().state_dict(), partial_path)
+    os.replace(partial_path, target)
+    del model
+    gc.collect()
+    return str(target)
+
+
+def attach_shared_weights(model: YOLO, weights_path: str):
+    """Swap a model's parameters for memory-mapped views of the shared fused weights"""
+    # Fuse first so the module layout matches the saved state and
+    # AutoBackend's own fuse() becomes a no-op that keeps the mapped tensors
+    model.fuse()
+    state = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    model.model.load_state_dict(state, assign=True)
+    print(f"Mapped shared weights from {weights_path}")
+
+
+# Process-wide registry so each weights file is loaded once
+_model_cache: Dict[Tuple[str, str, str, Optional[str]], YOLO] = {}
+_inferencer_cache: Dict[Tuple[str, type, str], 'YOLOInference'] = {}
+_registry_lock = threading.RLock()
+
+
+def load_model(model_path: str, device: Optional[str] = None, backend: Optional[str] = None,
+               enhance: Optional[str] = None) -> YOLO:
+    """Load YOLO weights once per process, device and backend, returning the shared model
+
+    ``enhance`` is the serving enhancement mode, which INT8 graphs are calibrated for.
+    """
+    device = device or get_device()
+    backend = get_backend(backend)
+    enhance = get_enhance_mode(enhance) if backend == 'onnx-int8' else None
+    key = (os.path.realpath(model_path), device, backend, enhance)
+    with _registry_lock:
+        model = _model_cache.get(key)
+        if model is None:
+            if backend == 'torch':
+                print(f"Loading model from: {model_path}")
+                model = YOLO(model_path)
+                # Set by InferenceProcessPool so its workers share one CPU copy
+                shared_weights = os.getenv('SHARED_WEIGHTS_PATH')
+                if shared_weights and device == 'cpu':
+                    attach_shared_weights(model, shared_weights)
+                model.to(device)
+            else:
+                # Exported graphs are placed by their runtime, not .to()
+                weights = export_weights(model_path, backend, enhance=enhance)
+                print(f"Loading {backend} model from: {weights}")
+                model = YOLO(weights, task='segment')
+            _model_cache[key] = model
+        return model
+
+
+def get_inferencer(model_path: str, cls: Optional[Type['YOLOInference']] = None,
+                   backend: Optional[str] = None) -> 'YOLOInference':
+    """Return the shared inferencer for a weights file, creating it on first use"""
+    cls = cls or OptimizedYOLOInference
+    backend = get_backend(backend)
+    key = (os.path.realpath(model_path), cls, backend)
+    with _registry_lock:
+        inferencer = _inferencer_cache.get(key)
+        if inferencer is None:
+            inferencer = cls(model_path, backend=backend)
+            _inferencer_cache[key] = inferencer
+        return inferencer
+
+
+def export_for_workers(model_path: str, backend: Optional[str] = None, enhance: Optional[str] = None,
+                       cls: Optional[Type['YOLOInference']] = None) -> str:
+    """Export the graph worker processes will load before spawning them, so they never race to write it
+
+    ``enhance`` overrides the serving enhancement mode of ``cls`` that INT8 graphs are calibrated for.
+    """
+    cls = cls or OptimizedYOLOInference
+    enhance = enhance or get_enhance_mode(os.getenv('ENHANCE_MODE'), cls.default_enhance_mode)
+    return export_weights(model_path, get_backend(backend), enhance=enhance)
+
+
 class YOLOInference:
-    def __init__(self, model_path: str):
-        """Initialize with path to trained YOLO model weights"""
-        print(f"Loading model from: {model_path}")
-        self.device = get_device()
-        print(f"Using device: {self.device}")
+    # Overridden per deployment by ENHANCE_MODE
+    default_enhance_mode = 'threshold'
 
-        self.model = YOLO(model_path)
-        self.model.to(self.device)
+    def __init__(self, model_path: str, backend: Optional[str] = None):
+        """Initialize with path to trained YOLO model weights
+
+        ``backend`` (or YOLO_BACKEND) picks eager PyTorch or an exported
+        ONNX Runtime / OpenVINO graph for CPU-only nodes.
+        """
+        self.model_path = model_path
+        self.backend = get_backend(backend)
+        # Exported backends run on their CPU runtimes
+        self.device = get_device() if self.backend == 'torch' else 'cpu'
+        print(f"Using device: {self.device} ({self.backend} backend)")
+
+        self.enhance_mode = get_enhance_mode(os.getenv('ENHANCE_MODE'), self.default_enhance_mode)
+        self.model = load_model(model_path, self.device, self.backend, self.enhance_mode)
 
         # Detection parameters
         self.conf_threshold = 0.1
@@ -40,38 +245,33 @@ class YOLOInference:
             torch.backends.cuda.matmul.allow_tf32 = True
             torch.backends.cudnn.allow_tf32 = True
 
-    def enhance_image(self, image: np.ndarray) -> np.ndarray:
-        """Apply document-specific image enhancement"""
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
-
-        thresh = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY, 11, 2
+    def cache_settings(self) -> Tuple:
+        """Settings that change inference output, for keying result caches"""
+        return (
+            os.path.realpath(self.model_path),
+            type(self).__name__,
+            self.backend,
+            self.conf_threshold,
+            self.iou_threshold,
+            self.enhance_mode,
         )
 
-        denoised = cv2.fastNlMeansDenoising(thresh)
-        enhanced = cv2.cvtColor(denoised, cv2.COLOR_GRAY2RGB)
-
-        return enhanced
+    def enhance_image(self, image: np.ndarray) -> np.ndarray:
+        """Apply document-specific image enhancement"""
+        return threshold_filter(image)
 
-    def preprocess_image(self, image, target_size=1024) -> Tuple[np.ndarray, Tuple[float, int, int]]:
+    def preprocess_image(self, image, target_size=1024,
+                         enhance: Optional[str] = None) -> Tuple[np.ndarray, Tuple[float, int, int]]:
         """Preprocess image while maintaining aspect ratio"""
-        if not isinstance(image, np.ndarray):
-            image = np.array(image)
-
-        image = self.enhance_image(image)
-
-        height, width = image.shape[:2]
+        height, width = image_hw(image)
         scale = min(target_size/width, target_size/height)
         new_width = int(width * scale)
         new_height = int(height * scale)
 
-        image = cv2.resize(
+        image = enhance_and_resize(
             image,
             (new_width, new_height),
+            get_enhance_mode(enhance, self.enhance_mode),
             interpolation=cv2.INTER_LANCZOS4
         )
 
@@ -87,6 +287,7 @@ class YOLOInference:
 
     def get_annotations(self, image) -> Dict[str, Any]:
         """Run inference and return annotations including segmentation masks"""
+        original_hw = image_hw(image)
         processed_img, preprocessing_params = self.preprocess_image(image)
         
         results = self.model.predict(
@@ -112,7 +313,7 @@ class YOLOInference:
             if hasattr(results[0], 'masks') and results[0].masks is not None:
                 annotations['masks'] = results[0].masks.data.cpu().numpy()
                 
-            return annotations
+            return scale_to_original(annotations, original_hw, target_size=1024)
         return {}
 
     def process_pdf(self, pdf_path: Path) -> List[Dict[str, Any]]:
@@ -126,7 +327,8 @@ class YOLOInference:
 
             annotations = []
             for i, image in enumerate(images, 1):
-                print(f"Processing page {i}/{len(images)}")
+                if DEBUG_PRINT:
+                    print(f"Processing page {i}/{len(images)}")
                 page_annotations = self.get_annotations(image)
                 if page_annotations:
                     page_annotations['original_size'] = image.size
@@ -140,9 +342,11 @@ class YOLOInference:
 
 
 class OptimizedYOLOInference(YOLOInference):
-    def __init__(self, model_path: str):
+    default_enhance_mode = 'bilateral'
+
+    def __init__(self, model_path: str, backend: Optional[str] = None):
         try:
-            super().__init__(model_path)
+            super().__init__(model_path, backend)
             # Initialize executor after super() call
             self.executor = ThreadPoolExecutor(max_workers=6)
             self.target_size = 1024
@@ -152,20 +356,39 @@ class OptimizedYOLOInference(YOLOInference):
                 self.model.model = self.model.model.float()
                 torch.mps.empty_cache()
 
-            # Limit cache size to prevent memory bloat
-            self._preprocess_cache = {}
-            self._cache_size_limit = 8
-
-            # Only compile model if not using MPS
-            if self.device != 'mps':
-                print("Compiling model for optimized inference")
-                self.model = torch.compile(
-                    self.model,
-                    mode='reduce-overhead',
-                    fullgraph=True,
-                    dynamic=False,
-                )
-                print("Model compiled successfully")
+            # Only compile eager PyTorch models, and not on MPS. Compilation
+            # happens in warmup(), once ultralytics has built its predictor.
+            self.compile_model = (
+                self.backend == 'torch' and self.device != 'mps'
+                and os.getenv('TORCH_COMPILE', '1') != '0'
+            )
+            self.compile_cache_dir = os.getenv('COMPILE_CACHE_DIR') or str(
+                Path(model_path).parent / '.compile_cache')
+            self._eager_network = None
+            self.ready = False
+
+            # CPU_PRECISION=bf16 runs the CPU network under bfloat16 autocast
+            # with channels_last activations, if it passes a parity check
+            # against float32 during warmup
+            self.cpu_precision = os.getenv('CPU_PRECISION', 'fp32').lower()
+            if self.cpu_precision not in ('fp32', 'bf16'):
+                raise ValueError(f"Unknown CPU_PRECISION '{self.cpu_precision}', expected fp32 or bf16")
+            self.precision = 'fp32'
+            self.memory_format = torch.contiguous_format
+
+            # TILE_MODE=auto runs images whose longest side reaches
+            # TILE_MIN_SIDE as overlapping full-resolution tiles instead of
+            # one downscaled letterbox; 'on' tiles anything bigger than a tile
+            self.tile_mode = os.getenv('TILE_MODE', 'off').lower()
+            self.tile_size = int(os.getenv('TILE_SIZE', str(self.target_size)))
+            self.tile_overlap = int(os.getenv('TILE_OVERLAP', '128'))
+            self.tile_min_side = int(os.getenv('TILE_MIN_SIDE', str(2 * self.target_size)))
+            # Tiles per forward pass, which bounds batch memory for huge scans
+            self.tile_batch_size = int(os.getenv('TILE_BATCH_SIZE', '8'))
+
+            # Chunk size for forward passes, tuned from measured throughput
+            # and memory; None (ADAPTIVE_BATCH=0) keeps callers' batch sizes
+            self.batch_controller = AdaptiveBatchController.from_env(self.device)
                 
         except Exception as e:
             print(f"Error initializing OptimizedYOLOInference: {e}")
@@ -173,175 +396,338 @@ class OptimizedYOLOInference(YOLOInference):
             self.executor = None
             raise
 
-    def enhance_image(self, image: np.ndarray) -> np.ndarray:
-        """Optimized document enhancement"""
-        if isinstance(image, np.ndarray):
-            if len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[2] == 1):
-                image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-            elif image.dtype != np.uint8:
-                image = (image * 255).astype(np.uint8)
+    def cache_settings(self) -> Tuple:
+        return super().cache_settings() + (
+            self.tile_mode, self.tile_size, self.tile_overlap, self.tile_min_side,
+            self.cpu_precision if self.device == 'cpu' and self.backend == 'torch' else None)
+
+    def _compile_network(self) -> bool:
+        """Compile the network the ultralytics predictor actually calls"""
+        autobackend = getattr(getattr(self.model, 'predictor', None), 'model', None)
+        network = getattr(autobackend, 'model', None)
+        if not isinstance(network, torch.nn.Module) or self._eager_network is not None:
+            return False
+
+        print("Compiling model for optimized inference")
+        self._eager_network = network
+        autobackend.model = torch.compile(
+            network,
+            mode='reduce-overhead' if self.device == 'cuda' else 'default',
+            dynamic=False,
+        )
+        return True
+
+    def _set_bf16(self, network: torch.nn.Module, enabled: bool):
+        """Switch the network between float32 and bf16 autocast with channels_last"""
+        head = network.model[-1]
+        if enabled:
+            network.forward = _autocast_forward(network.forward, True)
+            # Box decoding and mask prototypes stay float32, so coordinates keep full precision
+            head.forward = _autocast_forward(head.forward, False)
+            self.memory_format = torch.channels_last
         else:
-            image = np.array(image)
-            if len(image.shape) == 2:
-                image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-
-        return cv2.bilateralFilter(image, 9, 75, 75)
-
-    def preprocess_image(self, image) -> Tuple[np.ndarray, Tuple[float, int, int]]:
-        """Memory-optimized image preprocessing"""
-        if not isinstance(image, np.ndarray):
-            image = np.array(image)
-
-        cache_key = hash(image.tobytes())
-        if cache_key in self._preprocess_cache:
-            return self._preprocess_cache[cache_key]
+            network.__dict__.pop('forward', None)
+            head.__dict__.pop('forward', None)
+            self.memory_format = torch.contiguous_format
+        # Memory-mapped shared weights would be copied by a layout change;
+        # channels_last inputs alone still select the channels_last kernels
+        if not os.getenv('SHARED_WEIGHTS_PATH'):
+            network.to(memory_format=self.memory_format)
+        self.precision = 'bf16' if enabled else 'fp32'
+
+    def _parity_images(self, limit: int = 8) -> List[np.ndarray]:
+        directory = Path(os.getenv('CPU_PRECISION_PARITY_DIR') or os.getenv('QUANT_CALIBRATION_DIR', 'data/images'))
+        if not directory.is_dir():
+            return []
+        return [image for image in (read_rgb(path) for path in find_images(directory, limit)) if image is not None]
+
+    def _enable_bf16(self) -> bool:
+        """Turn on bf16 autocast if it matches float32 closely and runs faster; else stay float32
+
+        The head's raw scores and boxes are compared on a batch of images
+        from CPU_PRECISION_PARITY_DIR (random pixels if there are none), and
+        when images exist their final detections must also agree to
+        CPU_PRECISION_MIN_AGREEMENT in recall, precision, classes, box IoU
+        and mask IoU.
+        """
+        network = getattr(getattr(self.model, 'predictor', None), 'model', None)
+        network = getattr(network, 'model', None)
+        if not isinstance(network, torch.nn.Module):
+            print("Keeping float32 on CPU: no eager network to run in bfloat16")
+            return False
+
+        images = self._parity_images()
+        samples = images[:4] or [
+            np.random.default_rng(0).integers(0, 256, (self.target_size, self.target_size, 3), dtype=np.uint8)
+            for _ in range(2)]
+        batch, _ = self.preprocess_batch(samples)
+        reference, fp32_ms = _timed_forward(network, self._batch_to_tensor(batch))
+        reference_results = self._run_letterboxed(images, [None] * len(images), len(images)) if images else []
+
+        min_agreement = float(os.getenv('CPU_PRECISION_MIN_AGREEMENT', '0.95'))
+        problems = []
+        self._set_bf16(network, True)
+        try:
+            output, bf16_ms = _timed_forward(network, self._batch_to_tensor(batch))
+            nc = network.model[-1].nc
+            score_error = (output[:, 4:4 + nc] - reference[:, 4:4 + nc]).abs().max().item()
+            # Boxes only matter where float32 would keep a detection
+            kept = reference[:, 4:4 + nc].amax(dim=1) > self.conf_threshold
+            box_error = (output[:, :4] - reference[:, :4]).abs().amax(dim=1)[kept].max().item() if kept.any() else 0.0
+            if score_error > BF16_MAX_SCORE_ERROR:
+                problems.append(f"score error {score_error:.3f} > {BF16_MAX_SCORE_ERROR}")
+            if box_error > BF16_MAX_BOX_ERROR:
+                problems.append(f"box error {box_error:.2f}px > {BF16_MAX_BOX_ERROR}px")
+            if images:
+                report = agreement(reference_results,
+                                   self._run_letterboxed(images, [None] * len(images), len(images)))
+                for metric in ('recall', 'precision', 'class_agreement', 'mean_box_iou', 'mean_mask_iou'):
+                    if report[metric] is not None and report[metric] < min_agreement:
+                        problems.append(f"{metric} {report[metric]:.3f} < {min_agreement}")
+            if bf16_ms >= fp32_ms:
+                problems.append(f"not faster ({bf16_ms:.0f}ms vs {fp32_ms:.0f}ms in float32)")
+        except Exception as e:
+            problems.append(f"{type(e).__name__}: {e}")
+
+        if problems:
+            self._set_bf16(network, False)
+            print(f"Keeping float32 on CPU: {'; '.join(problems)}")
+            return False
+        print(f"Using bfloat16 autocast with channels_last on CPU: {fp32_ms:.0f}ms -> {bf16_ms:.0f}ms "
+              f"per batch of {len(samples)}, max score error {score_error:.3f}, max box error {box_error:.2f}px "
+              f"({len(images)} parity images)")
+        return True
+
+    def _restore_eager(self):
+        autobackend = self.model.predictor.model
+        autobackend.model = self._eager_network
+        self._eager_network = None
+
+    def _warmup_pass(self, image: np.ndarray, batch_size: int):
+        batch, _ = self.preprocess_batch([image] * batch_size)
+        self._predict(self._batch_to_tensor(batch), batch_size)
+
+    def warmup(self, batch_sizes: Sequence[int] = (1,)) -> float:
+        """Compile and run dummy batches for each batch size, then mark ready
+
+        Returns the warmup time in seconds. A compiled model that fails here
+        falls back to eager execution instead of failing live requests.
+        """
+        start = perf_counter()
+        dummy = np.full((self.target_size, self.target_size, 3), 255, dtype=np.uint8)
+        sizes = sorted({max(1, int(size)) for size in batch_sizes})
+
+        # The first pass builds ultralytics' predictor around the network
+        self._warmup_pass(dummy, 1)
+
+        # Precision is settled before compiling, so the graph is traced once
+        if self.cpu_precision == 'bf16' and self.device == 'cpu' and self.backend == 'torch':
+            self._enable_bf16()
+
+        compiled = False
+        if self.compile_model:
+            configure_compile_cache(self.compile_cache_dir)
+            # One graph per warmed batch size, since shapes are static
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, len(sizes) + 1)
+            compiled = self._compile_network()
+
+        for size in sizes:
+            pass_start = perf_counter()
+            try:
+                self._warmup_pass(dummy, size)
+            except Exception as e:
+                if not compiled:
+                    raise
+                print(f"Compiled model failed during warmup, using eager mode: {e}")
+                self._restore_eager()
+                compiled = False
+                self._warmup_pass(dummy, size)
+            print(f"Warmed up batch size {size} in {(perf_counter() - pass_start) * 1000:.2f}ms")
+
+        if compiled:
+            save_compile_cache(self.compile_cache_dir)
+            if self.batch_controller is not None:
+                # Static shapes: any other size would compile a new graph mid-request
+                self.batch_controller.restrict(sizes)
+
+        self.ready = True
+        elapsed = perf_counter() - start
+        print(f"Warmup finished in {elapsed:.2f}s")
+        return elapsed
 
-        # Clear cache if it exceeds size limit
-        if len(self._preprocess_cache) >= self._cache_size_limit:
-            self._preprocess_cache.clear()
+    def enhance_image(self, image: np.ndarray) -> np.ndarray:
+        """Optimized document enhancement"""
+        return bilateral_filter(to_rgb_uint8(image))
 
-        # Rest of the preprocessing code remains the same...
-        image = self.enhance_image(image)
-        height, width = image.shape[:2]
+    def _letterbox_into(self, out: np.ndarray, image, enhance: Optional[str] = None) -> Tuple[float, int, int]:
+        """Enhance and letterbox one image into a preallocated white square slot"""
+        height, width = image_hw(image)
         scale = min(self.target_size/width, self.target_size/height)
         new_width = int(width * scale)
         new_height = int(height * scale)
 
-        image = cv2.resize(image, (new_width, new_height),
-                           interpolation=cv2.INTER_LINEAR)
+        x_offset = (self.target_size - new_width) // 2
+        y_offset = (self.target_size - new_height) // 2
+        out[y_offset:y_offset+new_height,
+            x_offset:x_offset+new_width] = enhance_and_resize(
+                image, (new_width, new_height), get_enhance_mode(enhance, self.enhance_mode))
+
+        return scale, x_offset, y_offset
 
+    def preprocess_image(self, image, enhance: Optional[str] = None) -> Tuple[np.ndarray, Tuple[float, int, int]]:
+        """Memory-optimized image preprocessing"""
         square_image = np.full(
             (self.target_size, self.target_size, 3), 255, dtype=np.uint8)
-        x_offset = (self.target_size - new_width) // 2
-        y_offset = (self.target_size - new_height) // 2
-        square_image[y_offset:y_offset+new_height,
-                     x_offset:x_offset+new_width] = image
+        params = self._letterbox_into(square_image, image, enhance)
+        return square_image, params
+
+    def preprocess_batch(self, images: List[Any],
+                         enhance: Optional[Sequence[Optional[str]]] = None) -> Tuple[np.ndarray, List[Tuple[float, int, int]]]:
+        """Letterbox N images of any size into one uint8 NHWC buffer.
+
+        Enhancement and resizing run on the thread pool, each worker writing
+        straight into its own slot. ``enhance`` optionally overrides the
+        enhancement mode per image. Returns the buffer and per-image
+        (scale, x_offset, y_offset) letterbox parameters.
+        """
+        batch = np.full(
+            (len(images), self.target_size, self.target_size, 3), 255, dtype=np.uint8)
+        modes = list(enhance) if enhance is not None else [None] * len(images)
+
+        if self.executor is None or len(images) == 1:
+            params = [self._letterbox_into(batch[i], img, mode) for i, (img, mode) in enumerate(zip(images, modes))]
+        else:
+            params = list(self.executor.map(self._letterbox_into, batch, images, modes))
 
-        result = (square_image, (scale, x_offset, y_offset))
-        self._preprocess_cache[cache_key] = result
-        return result
+        return batch, params
 
-    def process_pdf(self, pdf_path: Path) -> List[Dict[str, Any]]:
-        """Process PDF with optimized thread usage and dynamic batch sizing"""
+    def _batch_to_tensor(self, batch: np.ndarray) -> torch.Tensor:
+        """Single host-to-device copy and normalize for an NHWC uint8 batch
+
+        The permuted NHWC buffer already has channels_last strides, so one
+        conversion produces float32 in the network's memory format and one
+        in-place divide normalizes it, bit-identical to .contiguous().float() / 255.
+        """
+        tensor = torch.from_numpy(batch)
+        if self.device == 'cuda':
+            tensor = tensor.pin_memory()
+        tensor = tensor.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+        return tensor.to(torch.float32, memory_format=self.memory_format).div_(255.0)
+
+    @staticmethod
+    def _pdf_batch_size(total_pages: int) -> int:
+        """Dynamic batch sizing based on number of pages"""
+        if total_pages <= 4:
+            return max(1, total_pages)  # Process all at once for small PDFs
+        elif total_pages <= 8:
+            return 4  # Half batch for medium PDFs
+        elif total_pages <= 16:
+            return 6  # Larger batch for bigger PDFs
+        return 8  # Maximum batch size for very large PDFs
+
+    def _render_pages(self, pdf_path: Path, first_page: int, last_page: int,
+                      thread_count: int) -> List[Any]:
+        """Render an inclusive page range of a PDF to PIL images"""
+        return pdf2image.convert_from_path(
+            str(pdf_path),
+            dpi=300,
+            first_page=first_page,
+            last_page=last_page,
+            thread_count=thread_count
+        )
+
+    def stream_pdf(self, pdf_path: Path, batch_size: Optional[int] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Yield (page_number, annotations) per page, rendering pages lazily.
+
+        Only the current batch and the one being rendered ahead of it are held
+        in memory, so peak usage is bounded by batch size, not page count.
+        """
         pdf_path = Path(pdf_path)
         print(f"Processing PDF: {pdf_path}")
 
+        total_pages = int(pdf2image.pdfinfo_from_path(str(pdf_path))['Pages'])
+        if total_pages < 1:
+            return
+        if batch_size is None and self.batch_controller is None:
+            batch_size = self._pdf_batch_size(total_pages)
+        # Increase thread count for PDF conversion on M1
+        # M1 Pro has 8 performance + 2 efficiency cores
+        thread_count = min(8, max(4, os.cpu_count() - 2),
+                           batch_size or self.batch_controller.max_size)
+        if batch_size:
+            print(f"Using batch size of {batch_size} for {total_pages} pages")
+        else:
+            print(f"Using adaptive batch sizes for {total_pages} pages")
+
+        def next_range(first: int) -> Optional[Tuple[int, int]]:
+            # Adaptive ranges follow whatever size the controller has settled on by now
+            if first > total_pages:
+                return None
+            size = batch_size or self.batch_controller.batch_size
+            return first, min(first + size - 1, total_pages)
+
+        def render(page_range):
+            if self.executor is None:
+                return _completed(self._render_pages(pdf_path, *page_range, thread_count))
+            return self.executor.submit(self._render_pages, pdf_path, *page_range, thread_count)
+
+        page_range = next_range(1)
+        pending = render(page_range)
         try:
-            # Increase thread count for PDF conversion on M1
-            # M1 Pro has 8 performance + 2 efficiency cores
-            thread_count = min(8, max(4, os.cpu_count() - 2))
-            images = pdf2image.convert_from_path(
-                str(pdf_path), 
-                dpi=300,
-                thread_count=thread_count  # Increased from 4
-            )
-            print(f"Successfully converted PDF to {len(images)} images")
-
-            # Dynamic batch sizing based on number of pages
-            total_images = len(images)
-            if total_images <= 4:
-                batch_size = total_images  # Process all at once for small PDFs
-            elif total_images <= 8:
-                batch_size = 4  # Half batch for medium PDFs
-            elif total_images <= 16:
-                batch_size = 6  # Larger batch for bigger PDFs
-            else:
-                batch_size = 8  # Maximum batch size for very large PDFs
+            while page_range is not None:
+                first_page, last_page = page_range
+                batch_start = perf_counter()
+                batch = pending.result()
 
-            # Adjust batch size for MPS
-            # if self.device == 'mps':
-            #     batch_size = min(batch_size, 4)  # MPS works better with smaller batches
+                # Render the next range while this one runs through the model
+                page_range = next_range(last_page + 1)
+                pending = render(page_range) if page_range is not None else None
 
-            print(f"Using batch size of {batch_size} for {total_images} pages")
+                if DEBUG_PRINT:
+                    print(f"Processing pages {first_page}-{last_page} of {total_pages}")
+                batch_results = self.process_batch(batch, batch_size=len(batch))
 
-            all_annotations = []
-            
-            for i in range(0, total_images, batch_size):
-                batch_start = perf_counter()
-                batch = images[i:min(i + batch_size, total_images)]
-                current_batch_size = len(batch)
-                
-                print(f"Processing batch {i//batch_size + 1}/{(total_images + batch_size - 1)//batch_size} "
-                    f"({current_batch_size} images)")
-                
-                batch_results = self.process_batch(batch, batch_size=current_batch_size)
-                
-                for result, image in zip(batch_results, batch):
+                for page_number, result, image in zip(range(first_page, last_page + 1), batch_results, batch):
                     if result:
                         result['original_size'] = image.size
-                    all_annotations.append(result)
+                    yield page_number, result
 
-                batch_time = (perf_counter() - batch_start) * 1000
-                print(f"Batch processed in {batch_time:.2f}ms "
-                    f"({batch_time/current_batch_size:.2f}ms per image)")
+                if DEBUG_PRINT:
+                    batch_time = (perf_counter() - batch_start) * 1000
+                    print(f"Batch processed in {batch_time:.2f}ms "
+                        f"({batch_time/len(batch):.2f}ms per image)")
 
-                # Force garbage collection after each batch
-                import gc
+                # Release page images before the next batch arrives
+                del batch, batch_results
                 gc.collect()
                 if self.device == 'cuda':
                     torch.cuda.empty_cache()
                 elif self.device == 'mps':
                     torch.mps.empty_cache()
+        finally:
+            if pending is not None:
+                pending.cancel()
 
-            # print(all_annotations)
-            return all_annotations
-
+    def process_pdf(self, pdf_path: Path) -> List[Dict[str, Any]]:
+        """Process PDF with optimized thread usage and dynamic batch sizing"""
+        try:
+            return [annotations for _, annotations in self.stream_pdf(pdf_path)]
         except Exception as e:
             print(f"Error processing PDF: {e}")
             raise
 
-    def process_batch(self, images: List[np.ndarray], batch_size: int = 4) -> List[Dict[str, Any]]:
-        """Process images in batches with optimized memory handling"""
-        if not images:
-            return []
-
-        results = []
-        start_time = perf_counter()
-
-        try:
-            # For MPS device, process in smaller batches
-            if self.device == 'mps':
-                batch_size = min(batch_size, 2)
-
-            # Prepare tensors
-            batch_tensors = []
-            for img in images:
-                if not isinstance(img, np.ndarray):
-                    img = np.array(img)
+    def _predict(self, batch_tensor: torch.Tensor, batch_size: int) -> List[Any]:
+        """Run the model on a normalized NCHW batch, returning ultralytics Results"""
+        # Process in smaller sub-batches for MPS
+        if self.device == 'mps':
+            sub_batch_results = []
+            for i in range(0, len(batch_tensor), batch_size):
+                sub_batch_tensor = batch_tensor[i:i + batch_size]
                 
-                # Convert to tensor and normalize
-                tensor = torch.from_numpy(img).to(self.device)
-                tensor = tensor.float() / 255.0
-                tensor = tensor.permute(2, 0, 1).unsqueeze(0)
-                batch_tensors.append(tensor)
-
-            # Process in smaller sub-batches for MPS
-            if self.device == 'mps':
-                sub_batch_results = []
-                for i in range(0, len(batch_tensors), batch_size):
-                    sub_batch = batch_tensors[i:i + batch_size]
-                    sub_batch_tensor = torch.cat(sub_batch, dim=0)
-                    
-                    with torch.inference_mode():
-                        predictions = self.model.predict(
-                            source=sub_batch_tensor,
-                            conf=self.conf_threshold,
-                            iou=self.iou_threshold,
-                            agnostic_nms=True,
-                            max_det=50,
-                            save=False,
-                            imgsz=(1024, 1024),
-                            verbose=False,
-                            retina_masks=True  # Enable high-quality masks
-                        )
-                    sub_batch_results.extend(predictions)
-                predictions = sub_batch_results
-            else:
-                # For non-MPS devices, process the full batch
-                batch_tensor = torch.cat(batch_tensors, dim=0)
                 with torch.inference_mode():
                     predictions = self.model.predict(
-                        source=batch_tensor,
+                        source=sub_batch_tensor,
                         conf=self.conf_threshold,
                         iou=self.iou_threshold,
                         agnostic_nms=True,
@@ -351,36 +737,177 @@ class OptimizedYOLOInference(YOLOInference):
                         verbose=False,
                         retina_masks=True  # Enable high-quality masks
                     )
+                sub_batch_results.extend(predictions)
+            return sub_batch_results
+
+        # For non-MPS devices, process the full batch
+        with torch.inference_mode():
+            return self.model.predict(
+                source=batch_tensor,
+                conf=self.conf_threshold,
+                iou=self.iou_threshold,
+                agnostic_nms=True,
+                max_det=50,
+                save=False,
+                imgsz=(1024, 1024),
+                verbose=False,
+                retina_masks=True  # Enable high-quality masks
+            )
+
+    def _tile_plan(self, image) -> Optional[List[Tile]]:
+        """Tiles for an image under the current TILE_MODE, or None to letterbox it whole"""
+        if self.tile_mode not in ('auto', 'on'):
+            return None
+        height, width = image_hw(image)
+        if self.tile_mode == 'auto' and max(height, width) < self.tile_min_side:
+            return None
+        tiles = tile_grid(height, width, self.tile_size, self.tile_overlap)
+        return tiles if len(tiles) > 1 else None
+
+    def process_batch(self, images: List[np.ndarray], batch_size: int = 4,
+                      enhance: Optional[Sequence[Optional[str]]] = None,
+                      raise_errors: bool = False) -> List[Dict[str, Any]]:
+        """Process images in batches, tiling large ones when TILE_MODE allows
+
+        ``enhance`` optionally overrides the enhancement mode per image.
+        ``batch_size`` is only a hint once the adaptive batch controller is on.
+        A failed batch comes back as empty results unless ``raise_errors``
+        is set, for callers that must tell failures from "no detections".
+        """
+        if not images:
+            return []
 
-            # Process results
-            for pred in predictions:
+        plans = [self._tile_plan(image) for image in images]
+        if not any(plans):
+            return self._process_letterboxed(images, batch_size, enhance, raise_errors)
+        return self._process_tiled(images, plans, batch_size, enhance, raise_errors)
+
+    def _process_tiled(self, images: List[Any], plans: List[Optional[List[Tile]]],
+                       batch_size: int, enhance: Optional[Sequence[Optional[str]]] = None,
+                       raise_errors: bool = False) -> List[Dict[str, Any]]:
+        """Run tiles and whole images through shared batches, then merge each image's tiles.
+
+        Tiles are views into the source image, and each tile's detections are
+        cropped to their boxes as soon as their batch finishes, so working
+        memory follows ``tile_batch_size`` rather than the scan size.
+        """
+        modes = list(enhance) if enhance is not None else [None] * len(images)
+        # (image index, tile index or None, input, enhancement mode)
+        entries = []
+        for index, (image, plan) in enumerate(zip(images, plans)):
+            if plan is None:
+                entries.append((index, None, image, modes[index]))
+                continue
+            array = image if isinstance(image, np.ndarray) else np.asarray(image)
+            entries.extend(
+                (index, tile_index, array[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width], modes[index])
+                for tile_index, tile in enumerate(plan))
+
+        results: List[Dict[str, Any]] = [{} for _ in images]
+        detections = {index: [] for index, plan in enumerate(plans) if plan is not None}
+        chunk = max(batch_size, self.tile_batch_size)
+        for start in range(0, len(entries), chunk):
+            part = entries[start:start + chunk]
+            outputs = self._process_letterboxed(
+                [entry[2] for entry in part], len(part), [entry[3] for entry in part], raise_errors)
+            for (index, tile_index, _, _), output in zip(part, outputs):
+                if tile_index is None:
+                    results[index] = output
+                else:
+                    detections[index].extend(tile_detections(
+                        output, plans[index][tile_index], tile_index, image_hw(images[index])))
+            del outputs
+
+        for index, found in detections.items():
+            with stage_timer('tile_merge', device=self.device):
+                results[index] = merge_tile_detections(
+                    found, image_hw(images[index]), self.iou_threshold, max_det=50)
+            if results[index]:
+                results[index]['tiles'] = len(plans[index])
+        return results
+
+    def _process_letterboxed(self, images: List[Any], batch_size: int = 4,
+                             enhance: Optional[Sequence[Optional[str]]] = None,
+                             raise_errors: bool = False) -> List[Dict[str, Any]]:
+        """Letterbox each image whole and run them through the model
+
+        With the adaptive batch controller, images run in chunks of the size
+        it has measured as fastest, and a chunk that runs out of memory is
+        retried smaller instead of coming back empty.
+        """
+        if not images:
+            return []
+
+        modes = list(enhance) if enhance is not None else [None] * len(images)
+        start_time = perf_counter()
+
+        try:
+            if self.batch_controller is not None:
+                results = self.batch_controller.run(
+                    len(images),
+                    lambda start, end: self._run_letterboxed(images[start:end], modes[start:end], end - start))
+            else:
+                # For MPS device, process in smaller batches
+                if self.device == 'mps':
+                    batch_size = min(batch_size, 2)
+                results = self._run_letterboxed(images, modes, batch_size)
+
+        except Exception as e:
+            if raise_errors:
+                raise
+            if self.batch_controller is not None and is_out_of_memory(e):
+                # Out of memory even one image at a time; empty results would read as "no detections"
+                raise
+            print(f"Error in batch processing: {e}")
+            import traceback
+            print(traceback.format_exc())
+            results = [{} for _ in range(len(images))]
+
+        if DEBUG_PRINT:
+            print(f"Batch processed in {(perf_counter() - start_time) * 1000:.2f}ms")
+
+        return results
+
+    def _run_letterboxed(self, images: List[Any], modes: List[Optional[str]],
+                         batch_size: int) -> List[Dict[str, Any]]:
+        """Preprocess, predict and postprocess one batch of whole images"""
+        results = []
+        labels = {'batch_size': len(images), 'device': self.device}
+
+        # Letterbox everything into one buffer so mixed sizes can share a batch
+        with stage_timer('preprocess', **labels):
+            batch, preprocessing_params = self.preprocess_batch(images, modes)
+        with stage_timer('host_to_device', **labels):
+            batch_tensor = self._batch_to_tensor(batch)
+        del batch
+
+        with stage_timer('predict', **labels):
+            predictions = self._predict(batch_tensor, batch_size)
+
+        # Process results
+        with stage_timer('postprocess', **labels):
+            for pred, params, image in zip(predictions, preprocessing_params, images):
                 if pred.boxes is not None and len(pred.boxes) > 0:
                     with torch.inference_mode():
                         result = {
                             'boxes': pred.boxes.xyxy.cpu().numpy(),
                             'classes': pred.boxes.cls.cpu().numpy(),
                             'confidence': pred.boxes.conf.cpu().numpy(),
+                            'preprocessing_params': params,
                         }
-                        
+
                         # Add masks if available
                         if hasattr(pred, 'masks') and pred.masks is not None:
                             result['masks'] = pred.masks.data.cpu().numpy()
+
+                    # Boxes and masks back in the caller's pixel coordinates
+                    result = scale_to_original(result, image_hw(image), self.target_size)
                 else:
                     result = {}
                 results.append(result)
 
-        except Exception as e:
-            print(f"Error in batch processing: {e}")
-            import traceback
-            print(traceback.format_exc())
-            results.extend([{} for _ in range(len(images))])
-
-        end_time = perf_counter()
-        print(f"Batch processed in {(end_time - start_time) * 1000:.2f}ms")
-        
         return results
 
-
     def get_annotations(self, image) -> Dict[str, Any]:
         """Single image inference - now just processes a batch of size 1"""
         return self.process_batch([image], batch_size=4)[0]
@@ -390,8 +917,6 @@ class OptimizedYOLOInference(YOLOInference):
         try:
             if hasattr(self, 'executor') and self.executor is not None:
                 self.executor.shutdown()
-            if hasattr(self, '_preprocess_cache'):
-                self._preprocess_cache.clear()
             if hasattr(self, 'device') and self.device == 'mps':
                 torch.mps.empty_cache()
         except Exception as e:
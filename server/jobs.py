@@ -0,0 +1,506 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import pdf2image
+
+from mask_encoding import to_json_ready
+
+# Job lifecycle; items move pending -> running -> done/failed (or cancelled)
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Same render resolution as OptimizedYOLOInference.stream_pdf
+PDF_DPI = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    options TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    source TEXT NOT NULL,
+    page INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    seq INTEGER,
+    worker INTEGER,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, job_id);
+CREATE INDEX IF NOT EXISTS items_seq ON items (job_id, seq);
+"""
+
+# (filename, source path, page number or None for images)
+Item = Tuple[str, str, Optional[int]]
+
+
+class JobStore:
+    """Jobs and per-page results persisted in SQLite.
+
+    Every process opens its own connections, so the API process and the
+    worker processes share state only through the database file.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Autocommit; writers open their own IMMEDIATE transactions
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys=ON")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the database lock up front"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def create_job(self, job_id: str, items: Sequence[Item], options: Dict[str, Any]):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, options, total, created, updated) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(options), len(items), now, now))
+            conn.executemany(
+                "INSERT INTO items (job_id, idx, filename, source, page) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, idx, filename, source, page) for idx, (filename, source, page) in enumerate(items)])
+
+    def pending_items(self) -> int:
+        """Items queued or in progress across all jobs"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM items WHERE status IN ('pending', 'running')").fetchone()
+        return row[0]
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        return {
+            "job_id": job['id'],
+            "status": job['status'],
+            "options": json.loads(job['options']),
+            "total": job['total'],
+            "completed": counts.get('done', 0) + counts.get('failed', 0),
+            "failed": counts.get('failed', 0),
+            "pending": counts.get('pending', 0) + counts.get('running', 0),
+            "error": job['error'],
+            "created": job['created'],
+            "updated": job['updated'],
+        }
+
+    def results(self, job_id: str, after: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Finished items in completion order, starting after sequence number ``after``"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT idx, filename, page, status, seq, result, error FROM items "
+                "WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, after, limit)).fetchall()
+        return [{
+            "seq": row['seq'],
+            "index": row['idx'],
+            "filename": row['filename'],
+            "page": row['page'],
+            "status": row['status'],
+            "annotations": json.loads(row['result']) if row['result'] else {},
+            "error": row['error'],
+        } for row in rows]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job's pending items; items already running still finish"""
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (now, job_id)).rowcount
+            if updated:
+                conn.execute(
+                    "UPDATE items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job_id,))
+        return bool(updated)
+
+    def claim(self, worker: int, limit: int) -> Optional[Tuple[str, Dict[str, Any], List[sqlite3.Row]]]:
+        """Atomically take up to ``limit`` pending items from the oldest active job"""
+        with self._transaction() as conn:
+            job = conn.execute(
+                "SELECT id, options FROM jobs WHERE status IN ('queued', 'running') AND EXISTS "
+                "(SELECT 1 FROM items WHERE items.job_id = jobs.id AND items.status = 'pending') "
+                "ORDER BY created LIMIT 1").fetchone()
+            if job is None:
+                return None
+            items = conn.execute(
+                "SELECT idx, filename, source, page FROM items WHERE job_id = ? AND status = 'pending' "
+                "ORDER BY idx LIMIT ?", (job['id'], limit)).fetchall()
+            conn.executemany(
+                "UPDATE items SET status = 'running', worker = ? WHERE job_id = ? AND idx = ?",
+                [(worker, job['id'], item['idx']) for item in items])
+            conn.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job['id']))
+        return job['id'], json.loads(job['options']), items
+
+    def complete(self, job_id: str, records: Sequence[Tuple[int, Optional[str], Optional[str]]]) -> bool:
+        """Record (idx, result JSON, error) for claimed items; True once the job has nothing left running"""
+        now = time.time()
+        with self._transaction() as conn:
+            job = conn.execute("SELECT seq FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                # Purged while the batch ran
+                return True
+            seq = job['seq']
+            for idx, result, error in records:
+                seq += 1
+                conn.execute(
+                    "UPDATE items SET status = ?, seq = ?, result = ?, error = ? WHERE job_id = ? AND idx = ?",
+                    ('failed' if error else 'done', seq, result, error, job_id, idx))
+            conn.execute("UPDATE jobs SET seq = ?, updated = ? WHERE id = ?", (seq, now, job_id))
+
+            remaining = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM items WHERE job_id = ? AND status IN ('pending', 'running', 'done') "
+                "GROUP BY status", (job_id,)).fetchall())
+            finished = not remaining.get('pending') and not remaining.get('running')
+            if finished:
+                status = 'completed' if remaining.get('done') else 'failed'
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ? WHERE id = ? AND status = 'running'",
+                    (status, None if status == 'completed' else "Every item failed", job_id))
+        return finished
+
+    def is_idle(self, job_id: str) -> bool:
+        """True when no worker holds items of the job"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM items WHERE job_id = ? AND status = 'running'", (job_id,)).fetchone()
+        return row[0] == 0
+
+    def requeue_running(self) -> int:
+        """Return items held by workers that died with the previous process back to the queue"""
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE items SET status = 'pending', worker = NULL WHERE status = 'running'").rowcount
+
+    def running_items(self, worker: int) -> List[Tuple[str, int]]:
+        """(job ID, idx) of the items a worker holds"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT job_id, idx FROM items WHERE status = 'running' AND worker = ?", (worker,)).fetchall()
+        return [(row['job_id'], row['idx']) for row in rows]
+
+    def requeue(self, job_id: str, indices: Sequence[int]) -> int:
+        """Return running items of a job back to the queue"""
+        with self._transaction() as conn:
+            return sum(conn.execute(
+                "UPDATE items SET status = 'pending', worker = NULL WHERE job_id = ? AND idx = ? "
+                "AND status = 'running'", (job_id, idx)).rowcount for idx in indices)
+
+    def purge(self, older_than: float) -> List[str]:
+        """Delete finished jobs last updated before ``older_than``, returning their IDs"""
+        with self._transaction() as conn:
+            placeholders = ','.join('?' * len(TERMINAL_STATUSES))
+            ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({placeholders}) AND updated < ?",
+                (*TERMINAL_STATUSES, older_than)).fetchall()]
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in ids])
+        return ids
+
+
+def _is_pdf(filename: str, head: bytes) -> bool:
+    return head.startswith(b'%PDF') or filename.lower().endswith('.pdf')
+
+
+def _load_items(items: Sequence[sqlite3.Row]) -> List[Tuple[int, Any, Optional[str]]]:
+    """Read claimed items as (idx, image, error), rendering consecutive PDF pages together"""
+    loaded = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if item['page'] is None:
+            image = cv2.imread(item['source'], cv2.IMREAD_COLOR)
+            if image is None:
+                loaded.append((item['idx'], None, f"Failed to decode image: {item['filename']}"))
+            else:
+                loaded.append((item['idx'], cv2.cvtColor(image, cv2.COLOR_BGR2RGB), None))
+            i += 1
+            continue
+
+        # Extend over the run of consecutive pages from the same PDF
+        j = i + 1
+        while (j < len(items) and items[j]['source'] == item['source']
+               and items[j]['page'] == items[j - 1]['page'] + 1):
+            j += 1
+        run = items[i:j]
+        try:
+            pages = pdf2image.convert_from_path(
+                item['source'], dpi=PDF_DPI,
+                first_page=run[0]['page'], last_page=run[-1]['page'],
+                thread_count=min(len(run), 4))
+            loaded.extend((row['idx'], page, None) for row, page in zip(run, pages))
+        except Exception as e:
+            loaded.extend((row['idx'], None, f"Failed to render page {row['page']}: {e}") for row in run)
+        i = j
+    return loaded
+
+
+def _worker_main(db_path: str, inputs_dir: str, model_path: str, backend: Optional[str],
+                 batch_size: int, threads: int, poll_interval: float, stop_event):
+    """Worker process loop: load the model once, then claim and run batches until stopped"""
+    import torch
+    from inference import get_inferencer
+
+    if threads:
+        torch.set_num_threads(threads)
+    store = JobStore(db_path)
+    inferencer = get_inferencer(model_path, backend=backend)
+    try:
+        inferencer.warmup(list(range(1, batch_size + 1)))
+    except Exception as e:
+        print(f"Job worker {os.getpid()} warmup failed: {e}")
+    print(f"Job worker {os.getpid()} ready")
+
+    while not stop_event.is_set():
+        claimed = store.claim(os.getpid(), batch_size)
+        if claimed is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        job_id, options, items = claimed
+        records = []
+        try:
+            loaded = _load_items(items)
+            ready = [(idx, image) for idx, image, error in loaded if error is None]
+            annotations = inferencer.process_batch(
+                [image for _, image in ready], batch_size=len(ready),
+                enhance=[options.get('enhance')] * len(ready), raise_errors=True) if ready else []
+            pages = {item['idx']: item['page'] for item in items}
+            for (idx, image), result in zip(ready, annotations):
+                if result and pages[idx] is not None:
+                    # PDF pages keep their rendered (width, height) like stream_pdf
+                    result['original_size'] = image.size
+                formatted = to_json_ready(result, options.get('mask_format', 'rle'),
+                                          options.get('mask_crop', False))
+                records.append((idx, json.dumps(formatted), None))
+            records.extend((idx, None, error) for idx, _, error in loaded if error is not None)
+        except Exception as e:
+            print(f"Job {job_id} batch failed: {e}")
+            records = [(item['idx'], None, str(e)) for item in items]
+
+        if store.complete(job_id, records) and store.is_idle(job_id):
+            shutil.rmtree(Path(inputs_dir) / job_id, ignore_errors=True)
+
+
+class JobManager:
+    """Accepts image and PDF jobs and runs them on inference worker processes.
+
+    Uploads are written under ``jobs_dir``; each worker process loads the
+    model once and claims batches of pages from the shared SQLite queue, so
+    queued work survives a restart. ``max_pending_items`` bounds the queue.
+
+    Workers are supervised: one that dies is respawned and its items are
+    requeued once; items held by a worker that dies a second time on them
+    fail instead, so a page that crashes the model cannot stall its job.
+    """
+
+    def __init__(self, jobs_dir: str, model_path: str, backend: Optional[str] = None,
+                 workers: int = 1, batch_size: int = 4, max_pending_items: int = 2000,
+                 retention_seconds: float = 24 * 3600, poll_interval: float = 0.2,
+                 supervise_interval: float = 2.0):
+        self.jobs_dir = Path(jobs_dir)
+        self.inputs_dir = self.jobs_dir / 'inputs'
+        self.inputs_dir.mkdir(parents=True, exist_ok=True)
+        self.store = JobStore(str(self.jobs_dir / 'jobs.sqlite3'))
+
+        self.model_path = model_path
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.max_pending_items = max_pending_items
+        self.retention_seconds = retention_seconds
+        self.poll_interval = poll_interval
+        self.supervise_interval = supervise_interval
+        # Split cores between workers so their torch pools do not oversubscribe
+        self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+
+        # Spawn, not fork: the parent already holds torch threads and maybe CUDA
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = self._context.Event()
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+        self._supervisor: Optional[threading.Thread] = None
+        # Items already requeued once after their worker died
+        self._crashed: set = set()
+        self.restarts = 0
+
+    @classmethod
+    def from_env(cls, model_path: str, backend: Optional[str] = None) -> Optional["JobManager"]:
+        """Build a manager from JOB_* variables; jobs are off unless JOB_WORKERS is set.
+
+        Each job worker loads its own copy of the model next to the serving
+        inferencer, so enabling jobs costs that memory and splits the cores.
+        """
+        workers = int(os.getenv('JOB_WORKERS', '0'))
+        if workers <= 0:
+            return None
+        return cls(
+            jobs_dir=os.getenv('JOBS_DIR', 'jobs'),
+            model_path=model_path,
+            backend=backend,
+            workers=workers,
+            batch_size=int(os.getenv('JOB_BATCH_SIZE', '4')),
+            max_pending_items=int(os.getenv('JOB_MAX_PENDING_ITEMS', '2000')),
+            retention_seconds=float(os.getenv('JOB_RETENTION_HOURS', '24')) * 3600,
+        )
+
+    def start(self):
+        requeued = self.store.requeue_running()
+        if requeued:
+            print(f"Requeued {requeued} job items left running by a previous process")
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        self._supervisor = threading.Thread(target=self._supervise, name='job-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def _spawn(self) -> multiprocessing.process.BaseProcess:
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.store.db_path, str(self.inputs_dir), self.model_path, self.backend,
+                  self.batch_size, self.threads, self.poll_interval, self._stop),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _supervise(self):
+        while not self._stop.wait(self.supervise_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Job supervisor error: {e}")
+
+    def reap(self):
+        """Respawn dead workers and requeue or fail the items they held"""
+        for position, process in enumerate(self._processes):
+            if process.is_alive() or self._stop.is_set():
+                continue
+            print(f"Job worker {process.pid} exited with code {process.exitcode}, restarting")
+            held: Dict[str, List[int]] = {}
+            for job_id, idx in self.store.running_items(process.pid):
+                held.setdefault(job_id, []).append(idx)
+            for job_id, indices in held.items():
+                retry = [idx for idx in indices if (job_id, idx) not in self._crashed]
+                give_up = [idx for idx in indices if (job_id, idx) in self._crashed]
+                self._crashed.update((job_id, idx) for idx in retry)
+                self.store.requeue(job_id, retry)
+                if give_up:
+                    error = "Worker process died twice on this item"
+                    if self.store.complete(job_id, [(idx, None, error) for idx in give_up]) \
+                            and self.store.is_idle(job_id):
+                        shutil.rmtree(self.inputs_dir / job_id, ignore_errors=True)
+            self._processes[position] = self._spawn()
+            self.restarts += 1
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._supervisor is not None:
+            self._supervisor.join(timeout)
+            self._supervisor = None
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+
+    def alive_workers(self) -> int:
+        return sum(process.is_alive() for process in self._processes)
+
+    def has_capacity(self, items: int = 1) -> bool:
+        return self.store.pending_items() + items <= self.max_pending_items
+
+    def submit(self, uploads: Sequence[Tuple[str, BinaryIO]], options: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Persist uploads and queue one item per image or PDF page.
+
+        Returns the job status, or None when the queue has no room for it.
+        """
+        self._purge()
+        job_id = uuid.uuid4().hex
+        job_dir = self.inputs_dir / job_id
+        job_dir.mkdir(parents=True)
+
+        items: List[Item] = []
+        try:
+            for position, (filename, stream) in enumerate(uploads):
+                filename = filename or f"upload-{position}"
+                path = job_dir / f"{position}{Path(filename).suffix.lower()}"
+                with open(path, 'wb') as out:
+                    shutil.copyfileobj(stream, out)
+                with open(path, 'rb') as saved:
+                    head = saved.read(4)
+
+                if _is_pdf(filename, head):
+                    pages = int(pdf2image.pdfinfo_from_path(str(path))['Pages'])
+                    items.extend((filename, str(path), page) for page in range(1, pages + 1))
+                else:
+                    items.append((filename, str(path), None))
+
+            if not items or not self.has_capacity(len(items)):
+                shutil.rmtree(job_dir, ignore_errors=True)
+                return None
+            self.store.create_job(job_id, items, options)
+        except Exception:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        return self.store.get_job(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        cancelled = self.store.cancel(job_id)
+        # Running items finish in their worker, which then removes the inputs
+        if cancelled and self.store.is_idle(job_id):
+            shutil.rmtree(self.inputs_dir / job_id, ignore_errors=True)
+        return cancelled
+
+    def _purge(self):
+        for job_id in self.store.purge(time.time() - self.retention_seconds):
+            shutil.rmtree(self.inputs_dir / job_id, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "alive_workers": self.alive_workers(),
+            "restarts": self.restarts,
+            "pending_items": self.store.pending_items(),
+            "max_pending_items": self.max_pending_items,
+        }
@@ -0,0 +1,176 @@
+import base64
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# 'raw' keeps the original nested float lists for existing clients
+MASK_FORMATS = ('raw', 'rle', 'png')
+
+
+class CroppedMasks:
+    """A stack of full-frame uint8 masks held as crops at their boxes.
+
+    Stands in for the dense (N, height, width) array: ``len``, ``shape``,
+    indexing and iteration work as before, materializing one full-frame
+    mask at a time, while storage and pickling cost only box area.
+    """
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, crops: Sequence[np.ndarray], origins: Sequence[Tuple[int, int]],
+                 frame_hw: Tuple[int, int]):
+        self.crops = list(crops)
+        self.origins = [tuple(origin) for origin in origins]
+        self.frame_hw = tuple(frame_hw)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return (len(self.crops),) + self.frame_hw
+
+    @property
+    def nbytes(self) -> int:
+        return sum(crop.nbytes for crop in self.crops)
+
+    def __len__(self) -> int:
+        return len(self.crops)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        crop = self.crops[index]
+        x, y = self.origins[index]
+        mask = np.zeros(self.frame_hw, dtype=np.uint8)
+        mask[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+        return mask
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return (self[i] for i in range(len(self)))
+
+    def items(self) -> Iterator[Tuple[np.ndarray, Tuple[int, int]]]:
+        """(crop, (x, y) origin) pairs without materializing full frames"""
+        return zip(self.crops, self.origins)
+
+    def crop_to_box(self, index: int, box: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Same result as ``crop_to_box(self[index], box)`` without building the full frame"""
+        x1, y1, x2, y2 = _box_region(box, *self.frame_hw)
+        crop = self.crops[index]
+        x, y = self.origins[index]
+        if (x, y) == (x1, y1) and crop.shape == (y2 - y1, x2 - x1):
+            return crop, (x1, y1)
+        out = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        ox1, oy1 = max(x, x1), max(y, y1)
+        ox2, oy2 = min(x + crop.shape[1], x2), min(y + crop.shape[0], y2)
+        if ox2 > ox1 and oy2 > oy1:
+            out[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = crop[oy1 - y:oy2 - y, ox1 - x:ox2 - x]
+        return out, (x1, y1)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        dense = np.zeros(self.shape, dtype=np.uint8)
+        for i, (crop, (x, y)) in enumerate(self.items()):
+            dense[i, y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+        return dense if dtype is None else dense.astype(dtype)
+
+    def tolist(self) -> List[Any]:
+        return np.asarray(self).tolist()
+
+
+def _box_region(box: np.ndarray, height: int, width: int) -> Tuple[int, int, int, int]:
+    """Whole-pixel (x1, y1, x2, y2) covering a box, clipped to the frame"""
+    x1, y1, x2, y2 = box
+    x1 = int(np.clip(np.floor(x1), 0, width))
+    y1 = int(np.clip(np.floor(y1), 0, height))
+    x2 = int(np.clip(np.ceil(x2), x1, width))
+    y2 = int(np.clip(np.ceil(y2), y1, height))
+    return x1, y1, x2, y2
+
+
+def crop_to_box(mask: np.ndarray, box: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Crop a mask to its detection box, returning the crop and its (x, y) origin"""
+    x1, y1, x2, y2 = _box_region(box, *mask.shape[:2])
+    return mask[y1:y2, x1:x2], (x1, y1)
+
+
+def crop_mask(masks: Any, index: int, box: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Crop one mask of a dense or ``CroppedMasks`` stack to its box"""
+    if isinstance(masks, CroppedMasks):
+        return masks.crop_to_box(index, box)
+    return crop_to_box(masks[index], box)
+
+
+def encode_rle(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode a binary mask as uncompressed COCO RLE (column-major run lengths)"""
+    height, width = mask.shape[:2]
+    flat = np.asarray(mask, dtype=bool).ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    # COCO runs always start with background
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {'size': [height, width], 'counts': counts.tolist()}
+
+
+def decode_rle(rle: Dict[str, Any]) -> np.ndarray:
+    """Decode an uncompressed COCO RLE back into a boolean mask"""
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    flat = np.repeat(values, counts)
+    return flat.reshape((height, width), order='F')
+
+
+def encode_png(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode a binary mask as a base64 single-channel PNG; an empty mask has empty data"""
+    height, width = mask.shape[:2]
+    if mask.size == 0:
+        # Degenerate or edge-clipped boxes crop to nothing, which PNG cannot hold
+        return {'size': [height, width], 'data': ''}
+    ok, buffer = cv2.imencode('.png', np.asarray(mask, dtype=np.uint8) * 255,
+                              [cv2.IMWRITE_PNG_BILEVEL, 1])
+    if not ok:
+        raise ValueError("Failed to encode mask as PNG")
+    return {'size': [height, width], 'data': base64.b64encode(buffer.tobytes()).decode('ascii')}
+
+
+def encode_masks(masks: np.ndarray, boxes: Optional[np.ndarray] = None,
+                 fmt: str = 'rle', crop: bool = False) -> List[Any]:
+    """Encode a stack of masks in the requested format, optionally cropped to boxes"""
+    if fmt not in MASK_FORMATS:
+        raise ValueError(f"Unknown mask format: {fmt}")
+    if crop and boxes is None:
+        raise ValueError("Cropping masks requires boxes")
+
+    encoded = []
+    for i in range(len(masks)):
+        origin = (0, 0)
+        if crop:
+            mask, origin = crop_mask(masks, i, boxes[i])
+        else:
+            mask = masks[i]
+
+        if fmt == 'raw':
+            item: Any = mask.tolist()
+            if crop:
+                item = {'data': item, 'origin': list(origin)}
+        else:
+            binary = mask > 0.5
+            item = encode_rle(binary) if fmt == 'rle' else encode_png(binary)
+            if crop:
+                item['origin'] = list(origin)
+        encoded.append(item)
+
+    return encoded
+
+
+def to_json_ready(annotations: Dict[str, Any], mask_format: str = 'raw',
+                  mask_crop: bool = False) -> Dict[str, Any]:
+    """Convert numpy types to Python native types, encoding masks as requested"""
+    formatted = {}
+    for key, value in (annotations or {}).items():
+        if key == 'masks' and (mask_format != 'raw' or mask_crop or isinstance(value, CroppedMasks)):
+            formatted[key] = encode_masks(value, annotations.get('boxes'), mask_format, mask_crop)
+        elif isinstance(value, np.ndarray):
+            formatted[key] = value.tolist()
+        elif isinstance(value, np.generic):
+            formatted[key] = value.item()
+        else:
+            formatted[key] = value
+    return formatted
@@ -0,0 +1,96 @@
+from typing import Any, Dict, Tuple
+
+import cv2
+import numpy as np
+
+from mask_encoding import CroppedMasks
+
+
+def image_hw(image: Any) -> Tuple[int, int]:
+    """Height and width of a numpy or PIL image without copying it"""
+    if isinstance(image, np.ndarray):
+        return image.shape[0], image.shape[1]
+    width, height = image.size
+    return height, width
+
+
+def scale_to_original(annotations: Dict[str, Any], original_hw: Tuple[int, int],
+                      target_size: int = 1024) -> Dict[str, Any]:
+    """Undo the letterbox so boxes and masks are in original pixel coordinates.
+
+    Boxes are rescaled with a single array operation. Each mask is only
+    cropped and resized inside its own box, so the cost follows box area
+    rather than the full frame. Masks come back as ``CroppedMasks``: uint8
+    0/1 crops at their boxes standing in for the original-size stack.
+    """
+    if not annotations or 'preprocessing_params' not in annotations:
+        return annotations
+
+    height, width = original_hw
+    scale, x_offset, y_offset = annotations['preprocessing_params']
+    offsets = np.array([x_offset, y_offset, x_offset, y_offset], dtype=np.float32)
+
+    letterbox_boxes = np.asarray(annotations['boxes'], dtype=np.float32)
+    boxes = (letterbox_boxes - offsets) / scale
+    boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, width)
+    boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, height)
+    annotations['boxes'] = boxes
+
+    masks = annotations.get('masks')
+    if masks is not None and len(masks):
+        annotations['masks'] = _masks_to_original(
+            masks, letterbox_boxes, (height, width), scale, x_offset, y_offset, target_size)
+
+    return annotations
+
+
+def _masks_to_original(masks: np.ndarray, letterbox_boxes: np.ndarray, original_hw: Tuple[int, int],
+                       scale: float, x_offset: int, y_offset: int, target_size: int) -> CroppedMasks:
+    height, width = original_hw
+    mask_h, mask_w = masks.shape[1:3]
+    # Masks may be lower resolution than the letterbox when retina masks are off
+    mask_scale = np.array([mask_w, mask_h, mask_w, mask_h], dtype=np.float32) / target_size
+    limits = np.array([mask_w, mask_h, mask_w, mask_h])
+
+    # Whole-pixel box regions in mask space, one row per detection
+    mask_regions = letterbox_boxes * mask_scale
+    mask_regions[:, :2] = np.floor(mask_regions[:, :2])
+    mask_regions[:, 2:] = np.ceil(mask_regions[:, 2:])
+    mask_regions = np.clip(mask_regions, 0, limits).astype(np.int64)
+
+    # Where those mask pixel edges land in the original image
+    offsets = np.array([x_offset, y_offset, x_offset, y_offset], dtype=np.float32)
+    regions = np.rint((mask_regions / mask_scale - offsets) / scale).astype(np.int64)
+
+    # Only each box's own region is ever allocated
+    empty = np.zeros((0, 0), dtype=np.uint8)
+    crops, origins = [], []
+    for i, ((mx1, my1, mx2, my2), (x1, y1, x2, y2)) in enumerate(zip(mask_regions, regions)):
+        # Drop anything that falls in the letterbox padding
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2, cy2 = min(x2, width), min(y2, height)
+        if mx2 <= mx1 or my2 <= my1 or cx2 <= cx1 or cy2 <= cy1:
+            crops.append(empty)
+            origins.append((0, 0))
+            continue
+        crop = np.ascontiguousarray(masks[i, my1:my2, mx1:mx2], dtype=np.float32)
+        resized = cv2.resize(crop, (int(x2 - x1), int(y2 - y1)), interpolation=cv2.INTER_LINEAR) > 0.5
+        crops.append(resized[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1].astype(np.uint8))
+        origins.append((int(cx1), int(cy1)))
+
+    return CroppedMasks(crops, origins, (height, width))
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU between two sets of xyxy boxes, shape (len(a), len(b))"""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
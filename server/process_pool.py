@@ -0,0 +1,232 @@
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from backends import get_backend
+from inference import export_for_workers, export_shared_weights, get_device, get_inferencer
+from metrics import stage_timer
+
+
+def core_subsets(processes: int, cores: Optional[Sequence[int]] = None) -> List[List[int]]:
+    """Split the usable cores into ``processes`` contiguous, near-equal subsets"""
+    if cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            cores = os.sched_getaffinity(0)
+        else:
+            cores = range(os.cpu_count() or 1)
+    cores = sorted(cores)
+    processes = max(1, processes)
+    if processes > len(cores):
+        # More workers than cores: they share, round-robin
+        return [[cores[i % len(cores)]] for i in range(processes)]
+    size, extra = divmod(len(cores), processes)
+    subsets, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        subsets.append(cores[start:end])
+        start = end
+    return subsets
+
+
+def _serve(conn, model_path: str, backend: str, cores: List[int], weights_path: Optional[str]):
+    """Worker process: pin to ``cores``, load the model once, answer commands until told to stop"""
+    import torch
+
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    # One intra-op thread per pinned core, so workers never contend
+    torch.set_num_threads(max(1, len(cores)))
+    if weights_path:
+        os.environ['SHARED_WEIGHTS_PATH'] = weights_path
+
+    try:
+        inferencer = get_inferencer(model_path, backend=backend)
+    except Exception as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+        return
+    conn.send(('ok', {
+        'device': str(inferencer.device),
+        'cache_settings': inferencer.cache_settings(),
+    }))
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except (EOFError, OSError):
+            return
+        if command == 'stop':
+            return
+        try:
+            if command == 'warmup':
+                result = inferencer.warmup(payload)
+            elif command == 'batch':
+                images, enhance, raise_errors = payload
+                result = inferencer.process_batch(
+                    images, batch_size=len(images), enhance=enhance, raise_errors=raise_errors)
+            else:
+                raise ValueError(f"Unknown command: {command}")
+            conn.send(('ok', result))
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, index: int, cores: List[int], process, conn):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.conn = conn
+
+    def call(self, command: str, payload: Any = None) -> Any:
+        self.conn.send((command, payload))
+        return self.result()
+
+    def result(self) -> Any:
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError(f"Inference worker {self.index}: {result}")
+        return result
+
+
+class InferenceProcessPool:
+    """Inference across pinned worker processes behind the inferencer interface.
+
+    Each worker is pinned to its own core subset with a matching
+    ``torch.set_num_threads`` and loads the model once. On CPU the workers
+    memory-map one fused copy of the weights (see ``export_shared_weights``),
+    so RSS does not grow with the worker count. ``process_batch`` routes each
+    batch to an idle worker; with the micro-batcher allowed one batch per
+    worker, concurrent requests spread across all of them.
+    """
+
+    def __init__(self, model_path: str, backend: Optional[str] = None, processes: int = 2,
+                 cores: Optional[Sequence[int]] = None):
+        self.model_path = model_path
+        self.backend = get_backend(backend)
+        self.processes = max(1, processes)
+        self.core_subsets = core_subsets(self.processes, cores)
+
+        # Workers report their own device; this is only a placeholder until then
+        self.device = get_device() if self.backend == 'torch' else 'cpu'
+        self.ready = False
+        self._settings: Optional[Tuple] = None
+        self._weights_path: Optional[str] = None
+        self._warmup_sizes: List[int] = []
+
+        # Spawn, not fork: the parent runs threads and may hold CUDA state
+        self._context = multiprocessing.get_context('spawn')
+        self._workers: List[_Worker] = []
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._stopped = False
+
+    def start(self):
+        """Start every worker and wait until each has loaded the model"""
+        # Only CPU workers can share host weights; GPU workers each hold device copies
+        if self.backend == 'torch' and self.device == 'cpu':
+            self._weights_path = export_shared_weights(self.model_path)
+        else:
+            # Exported graphs are written once here; the export lock does not span processes
+            export_for_workers(self.model_path, self.backend)
+
+        workers = [self._spawn(index) for index in range(self.processes)]
+        for worker in workers:
+            info = worker.result()
+            self.device = info['device']
+            self._settings = tuple(info['cache_settings'])
+            self._workers.append(worker)
+            self._idle.put(worker)
+            print(f"Inference worker {worker.index} ready on cores {worker.cores} (pid {worker.process.pid})")
+
+    def _spawn(self, index: int) -> _Worker:
+        parent_conn, child_conn = self._context.Pipe()
+        cores = self.core_subsets[index]
+        process = self._context.Process(
+            target=_serve,
+            args=(child_conn, self.model_path, self.backend, cores, self._weights_path),
+            name=f"inference-{index}",
+            daemon=True,
+        )
+        process.start()
+        # Drop our copy of the child's end so recv() sees EOF if the worker dies
+        child_conn.close()
+        return _Worker(index, cores, process, parent_conn)
+
+    def stop(self, timeout: float = 10.0):
+        self._stopped = True
+        for worker in self._workers:
+            try:
+                worker.conn.send(('stop', None))
+            except (OSError, BrokenPipeError):
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self._workers.clear()
+
+    def cache_settings(self) -> Tuple:
+        """Same settings as the workers' inferencer, so cache keys match in-process serving"""
+        return self._settings
+
+    def warmup(self, batch_sizes: Sequence[int] = (1,)) -> float:
+        """Warm up all workers in parallel; returns the slowest worker's time"""
+        self._warmup_sizes = list(batch_sizes)
+        workers = [self._idle.get() for _ in range(len(self._workers))]
+        try:
+            for worker in workers:
+                worker.conn.send(('warmup', self._warmup_sizes))
+            elapsed = max(worker.result() for worker in workers)
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+        self.ready = True
+        return elapsed
+
+    def process_batch(self, images: List[Any], batch_size: int = 4,
+                      enhance: Optional[Sequence[Optional[str]]] = None,
+                      raise_errors: bool = False) -> List[Dict[str, Any]]:
+        """Run a batch on the next idle worker"""
+        worker = self._idle.get()
+        try:
+            with stage_timer('worker_batch', batch_size=len(images), device=self.device):
+                results = worker.call('batch', (list(images), enhance, raise_errors))
+        except (EOFError, OSError) as e:
+            print(f"Inference worker {worker.index} died: {e!r}")
+            self._replace(worker)
+            raise RuntimeError(f"Inference worker {worker.index} died") from e
+        except Exception:
+            self._idle.put(worker)
+            raise
+        self._idle.put(worker)
+        return results
+
+    def _replace(self, dead: _Worker):
+        """Respawn a dead worker in the background; the pool runs one short meanwhile"""
+        def respawn():
+            try:
+                worker = self._spawn(dead.index)
+                worker.result()
+                if self._warmup_sizes:
+                    worker.call('warmup', self._warmup_sizes)
+            except Exception as e:
+                print(f"Failed to respawn inference worker {dead.index}: {e}")
+                return
+            if self._stopped:
+                worker.conn.send(('stop', None))
+                return
+            self._workers[self._workers.index(dead)] = worker
+            self._idle.put(worker)
+            print(f"Inference worker {dead.index} respawned (pid {worker.process.pid})")
+
+        threading.Thread(target=respawn, name=f"respawn-{dead.index}", daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "processes": self.processes,
+            "alive": sum(worker.process.is_alive() for worker in self._workers),
+            "idle": self._idle.qsize(),
+            "shared_weights": self._weights_path,
+            "cores": [worker.cores for worker in self._workers],
+        }
@@ -0,0 +1,261 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from enhancement import enhance_and_resize
+from postprocess import box_iou
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg')
+
+
+def find_images(directory: Path, limit: Optional[int] = None) -> List[Path]:
+    """Sorted image files under a directory, matching what test.py scans"""
+    directory = Path(directory)
+    paths = sorted(p for p in directory.glob("**/*") if p.suffix.lower() in IMAGE_SUFFIXES)
+    return paths[:limit] if limit else paths
+
+
+def read_rgb(path: Path) -> Optional[np.ndarray]:
+    image = cv2.imread(str(path))
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def letterbox(image: np.ndarray, target_size: int = 1024, enhance: str = 'none') -> np.ndarray:
+    """Enhance and letterbox onto a white square the same way OptimizedYOLOInference does"""
+    height, width = image.shape[:2]
+    scale = min(target_size/width, target_size/height)
+    new_width = int(width * scale)
+    new_height = int(height * scale)
+    square_image = np.full((target_size, target_size, 3), 255, dtype=np.uint8)
+    x_offset = (target_size - new_width) // 2
+    y_offset = (target_size - new_height) // 2
+    square_image[y_offset:y_offset+new_height, x_offset:x_offset+new_width] = enhance_and_resize(
+        image, (new_width, new_height), enhance)
+    return square_image
+
+
+def calibration_images(calibration_dir: Optional[str] = None, limit: int = 64) -> Tuple[str, List[Path]]:
+    """Resolve the calibration directory (QUANT_CALIBRATION_DIR) and the images used from it"""
+    calibration_dir = calibration_dir or os.getenv('QUANT_CALIBRATION_DIR', 'data/images')
+    return calibration_dir, find_images(Path(calibration_dir), limit)
+
+
+def calibration_fingerprint(paths: List[Path], enhance: str) -> str:
+    """Digest of the calibration images and enhancement mode a quantized model was built from"""
+    digest = hashlib.sha256(enhance.encode())
+    for path in paths:
+        stat = path.stat()
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _calibration_reader(input_name: str, paths: List[Path],
+                        preprocess: Callable[[np.ndarray], np.ndarray]):
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class LetterboxCalibrationReader(CalibrationDataReader):
+        """Feed letterboxed local images to ONNX Runtime calibration one at a time"""
+
+        def __init__(self):
+            self._inputs = self._generate()
+
+        def _generate(self) -> Iterator[Dict[str, np.ndarray]]:
+            for path in paths:
+                image = read_rgb(path)
+                if image is None:
+                    continue
+                square = preprocess(image)
+                tensor = square.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+                yield {input_name: tensor}
+
+        def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+            return next(self._inputs, None)
+
+    return LetterboxCalibrationReader()
+
+
+def quantize_onnx(fp32_path: str, int8_path: str, calibration_dir: Optional[str] = None,
+                  limit: int = 64, preprocess: Callable[[np.ndarray], np.ndarray] = letterbox) -> str:
+    """Statically quantize an exported ONNX model to INT8 using local sample images"""
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    calibration_dir, paths = calibration_images(calibration_dir, limit)
+    if not paths:
+        raise FileNotFoundError(f"No calibration images found in {calibration_dir}")
+    print(f"Calibrating INT8 model on {len(paths)} images from {calibration_dir}")
+
+    session = onnxruntime.InferenceSession(fp32_path, providers=['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    del session
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepared_path = str(Path(tmp_dir) / "prepared.onnx")
+        try:
+            quant_pre_process(fp32_path, prepared_path)
+        except Exception as e:
+            print(f"Skipping quantization pre-processing: {e}")
+            prepared_path = fp32_path
+
+        quantize_static(
+            prepared_path,
+            int8_path,
+            _calibration_reader(input_name, paths, preprocess),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            weight_type=QuantType.QInt8,
+            activation_type=QuantType.QUInt8,
+            # Keep the detection/mask heads' elementwise ops in float
+            op_types_to_quantize=['Conv', 'MatMul'],
+        )
+
+    # Ultralytics reads stride, names and task from the model metadata
+    source = onnx.load(fp32_path)
+    quantized = onnx.load(int8_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, int8_path)
+
+    return int8_path
+
+
+def _match(reference: Dict[str, Any], candidate: Dict[str, Any], iou_threshold: float = 0.5) -> Dict[str, Any]:
+    """Greedy IoU matching of candidate detections against reference detections"""
+    ref_boxes = reference.get('boxes', np.zeros((0, 4)))
+    cand_boxes = candidate.get('boxes', np.zeros((0, 4)))
+    stats = {'reference': len(ref_boxes), 'candidate': len(cand_boxes),
+             'matched': 0, 'box_ious': [], 'mask_ious': [], 'class_agree': 0}
+    if len(ref_boxes) == 0 or len(cand_boxes) == 0:
+        return stats
+
+    ious = box_iou(ref_boxes, cand_boxes)
+    used_ref, used_cand = set(), set()
+    for flat in np.argsort(-ious, axis=None):
+        i, j = np.unravel_index(flat, ious.shape)
+        if ious[i, j] < iou_threshold:
+            break
+        if i in used_ref or j in used_cand:
+            continue
+        used_ref.add(i)
+        used_cand.add(j)
+        stats['matched'] += 1
+        stats['box_ious'].append(float(ious[i, j]))
+        stats['class_agree'] += int(reference['classes'][i] == candidate['classes'][j])
+
+        if 'masks' in reference and 'masks' in candidate:
+            ref_mask = reference['masks'][i] > 0.5
+            cand_mask = candidate['masks'][j] > 0.5
+            union = np.logical_or(ref_mask, cand_mask).sum()
+            if union:
+                stats['mask_ious'].append(float(np.logical_and(ref_mask, cand_mask).sum() / union))
+
+    return stats
+
+
+def agreement(reference: List[Dict[str, Any]], candidate: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Summarize box and mask agreement of candidate results against reference results"""
+    totals = {'reference': 0, 'candidate': 0, 'matched': 0, 'class_agree': 0}
+    box_ious: List[float] = []
+    mask_ious: List[float] = []
+    for ref, cand in zip(reference, candidate):
+        stats = _match(ref or {}, cand or {})
+        for key in totals:
+            totals[key] += stats[key]
+        box_ious.extend(stats['box_ious'])
+        mask_ious.extend(stats['mask_ious'])
+
+    return {
+        'recall': totals['matched'] / totals['reference'] if totals['reference'] else 1.0,
+        'precision': totals['matched'] / totals['candidate'] if totals['candidate'] else 1.0,
+        'class_agreement': totals['class_agree'] / totals['matched'] if totals['matched'] else 1.0,
+        'mean_box_iou': float(np.mean(box_ious)) if box_ious else None,
+        'mean_mask_iou': float(np.mean(mask_ious)) if mask_ious else None,
+        'reference_detections': totals['reference'],
+        'candidate_detections': totals['candidate'],
+    }
+
+
+def measure(inferencer, images: List[np.ndarray], batch_size: int = 4) -> Dict[str, Any]:
+    """Per-image latency at batch size 1 and throughput at ``batch_size``"""
+    inferencer.process_batch(images[:1], batch_size=1)  # warmup
+
+    results = []
+    latencies = []
+    for image in images:
+        start = perf_counter()
+        results.append(inferencer.process_batch([image], batch_size=1)[0])
+        latencies.append((perf_counter() - start) * 1000)
+
+    start = perf_counter()
+    for i in range(0, len(images), batch_size):
+        batch = images[i:i + batch_size]
+        inferencer.process_batch(batch, batch_size=len(batch))
+    elapsed = perf_counter() - start
+
+    return {
+        'latency_ms_mean': float(np.mean(latencies)),
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'throughput_images_per_s': len(images) / elapsed if elapsed > 0 else None,
+        'batch_size': batch_size,
+        'results': results,
+    }
+
+
+def compare(model_path: str, image_dir: str, reference_backend: str = 'torch',
+            candidate_backend: str = 'onnx-int8', batch_size: int = 4, limit: int = 32) -> Dict[str, Any]:
+    """Compare latency, throughput and detections of a quantized model against FP32"""
+    from inference import OptimizedYOLOInference
+
+    images = [img for img in (read_rgb(p) for p in find_images(Path(image_dir), limit)) if img is not None]
+    if not images:
+        raise FileNotFoundError(f"No images found in {image_dir}")
+
+    reference = measure(OptimizedYOLOInference(model_path, backend=reference_backend), images, batch_size)
+    candidate = measure(OptimizedYOLOInference(model_path, backend=candidate_backend), images, batch_size)
+
+    report = {
+        'model': model_path,
+        'images': len(images),
+        reference_backend: {k: v for k, v in reference.items() if k != 'results'},
+        candidate_backend: {k: v for k, v in candidate.items() if k != 'results'},
+        'agreement': agreement(reference['results'], candidate['results']),
+    }
+    if reference['throughput_images_per_s'] and candidate['throughput_images_per_s']:
+        report['speedup'] = candidate['throughput_images_per_s'] / reference['throughput_images_per_s']
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare an INT8 model against the FP32 model")
+    parser.add_argument('--weights', default=os.getenv('YOLO_WEIGHTS_PATH', "models/segment-2.pt"))
+    parser.add_argument('--images', default="data/images")
+    parser.add_argument('--reference', default='torch', help="Reference (FP32) backend")
+    parser.add_argument('--candidate', default='onnx-int8', help="Backend to compare")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=32, help="Maximum number of images")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = compare(args.weights, args.images, args.reference, args.candidate,
+                     args.batch_size, args.limit)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from mask_encoding import CroppedMasks
+
+
+def content_key(content: bytes, *settings: Any) -> str:
+    """Hash raw upload bytes together with the settings that affect the result"""
+    digest = hashlib.blake2b(content, digest_size=20)
+    digest.update(repr(settings).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _sizeof(value: Any) -> int:
+    """Approximate memory footprint of a cached value"""
+    if isinstance(value, (np.ndarray, CroppedMasks)):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(v) for v in value.values()) + 64 * len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value) + 8 * len(value)
+    return 64
+
+
+class ResultCache:
+    """LRU cache of final results bounded by a byte budget.
+
+    Entries evicted from memory are spilled to ``disk_dir`` when one is
+    configured and promoted back to memory on their next hit. The disk tier
+    is an LRU of its own bounded by ``disk_max_bytes``; file mtimes record
+    recency, so its order survives restarts.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    @classmethod
+    def from_env(cls) -> Optional["ResultCache"]:
+        """Build a cache from RESULT_CACHE_MB / RESULT_CACHE_DIR / RESULT_CACHE_DISK_MB, or None if disabled"""
+        max_mb = float(os.getenv('RESULT_CACHE_MB', '256'))
+        if max_mb <= 0:
+            return None
+        return cls(int(max_mb * 1024 * 1024), os.getenv('RESULT_CACHE_DIR') or None,
+                   int(float(os.getenv('RESULT_CACHE_DISK_MB', '1024')) * 1024 * 1024))
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = self._load(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, value, spill=False)
+        return value
+
+    def put(self, key: str, value: Any, spill: bool = True):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            # Too large for memory; keep it on disk only
+            if spill:
+                self._store(key, value)
+            return
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        # Disk writes happen outside the lock
+        for old_key, old_value in evicted:
+            self._store(old_key, old_value)
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.pkl"
+
+    def _scan_disk(self):
+        """Index entries left by a previous process, oldest first, and prune to the budget"""
+        for tmp_path in self.disk_dir.glob("*.tmp"):
+            tmp_path.unlink(missing_ok=True)
+        files = []
+        for path in self.disk_dir.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._prune_disk()
+
+    def _prune_disk(self):
+        """Delete least recently used disk entries until the tier fits its budget"""
+        with self._lock:
+            removed = []
+            while self._disk_bytes > self.disk_max_bytes and self._disk:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.disk_evictions += 1
+                removed.append(old_key)
+        for old_key in removed:
+            self._path(old_key).unlink(missing_ok=True)
+
+    def _store(self, key: str, value: Any):
+        if self.disk_dir is None:
+            return
+        path = self._path(key)
+        with self._lock:
+            stored = key in self._disk
+            if stored:
+                # Just left memory, so it is the most recently used entry on disk
+                self._disk.move_to_end(key)
+        if stored:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return
+        try:
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = tmp_path.stat().st_size
+            if size > self.disk_max_bytes:
+                tmp_path.unlink()
+                return
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing result cache entry {key}: {e}")
+            return
+
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+        self._prune_disk()
+
+    def _load(self, key: str) -> Optional[Any]:
+        if self.disk_dir is None:
+            return None
+        with self._lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        path = self._path(key)
+        try:
+            # Refresh the mtime so recency survives a restart
+            os.utime(path)
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Error reading result cache entry {key}: {e}")
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes if self.disk_dir is not None else None,
+                "disk_evictions": self.disk_evictions,
+            }
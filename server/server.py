@@ -1,7 +1,10 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from typing import List, Dict, Any
+from starlette.background import BackgroundTask
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple
+import asyncio
+import json
 import numpy as np
 import cv2
 import io
@@ -10,8 +13,18 @@ import os
 from pathlib import Path
 import torch
 
-from inference import OptimizedYOLOInference
+from admission import AdmissionController, AdmissionError, Reservation
+from inference import get_inferencer
+from jobs import JobManager, TERMINAL_STATUSES
 from annotate import YOLOVisualizer
+from batching import MicroBatcher
+from enhancement import ENHANCE_MODES
+from mask_encoding import MASK_FORMATS, to_json_ready
+from metrics import REGISTRY, stage_timer
+from process_pool import InferenceProcessPool
+from result_cache import ResultCache, content_key
+from visualization_store import VisualizationStore
+from workers import WorkerPools
 
 app = FastAPI(title="Image Analysis API")
 
@@ -23,19 +36,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-image debug output; printing raw masks is itself expensive
+DEBUG_PRINT = os.getenv('DEBUG_PRINT', '1') != '0'
+
 inference_model = None
 visualizer = None
+batcher = None
+pools = None
+result_cache = None
+visualization_store = None
+job_manager = None
+admission = None
+warmup_error = None
 
 def init_model():
     """Initialize the YOLO model and visualizer with error handling"""
-    global inference_model, visualizer
+    global inference_model, visualizer, batcher, pools, result_cache, visualization_store, job_manager, admission
     try:
         MODEL_PATH = os.getenv('YOLO_WEIGHTS_PATH', "models/segment-2.pt")
         if not os.path.exists(MODEL_PATH):
             raise FileNotFoundError(f"Model file not found: {MODEL_PATH}")
         
-        inference_model = OptimizedYOLOInference(MODEL_PATH)
-        visualizer = YOLOVisualizer(MODEL_PATH)
+        # YOLO_BACKEND=onnx-int8 serves the INT8 model calibrated on
+        # QUANT_CALIBRATION_DIR (see quantization.py for the accuracy report)
+        backend = os.getenv('YOLO_BACKEND', 'torch')
+        # SERVE_PROCESSES > 1 runs inference in pinned worker processes that
+        # share one copy of the weights; HTTP, caches and the store stay here
+        serve_processes = int(os.getenv('SERVE_PROCESSES', '1'))
+        if serve_processes > 1:
+            inference_model = InferenceProcessPool(MODEL_PATH, backend=backend, processes=serve_processes)
+            inference_model.start()
+        else:
+            inference_model = get_inferencer(MODEL_PATH, backend=backend)
+        # Visualizer only draws annotations, so it does not need its own model
+        visualizer = YOLOVisualizer()
+
+        # Blocking stages run on worker pools, never on the event loop;
+        # one inference thread per worker process keeps them all busy, and
+        # a single in-process model only ever runs one batch at a time
+        pools = WorkerPools.from_env(inference_workers=serve_processes)
+
+        # Share forward passes across concurrent /analyze requests
+        batcher = MicroBatcher(
+            inference_model,
+            max_batch_size=int(os.getenv('BATCH_MAX_SIZE', '8')),
+            max_wait_ms=float(os.getenv('BATCH_MAX_WAIT_MS', '10')),
+            executor=pools.inference,
+            max_concurrent_batches=pools.inference_workers,
+        )
+        batcher.start()
+
+        # Reject work beyond these limits instead of queueing it without bound
+        admission = AdmissionController.from_env()
+
+        # Repeat uploads skip decoding, inference and rendering
+        result_cache = ResultCache.from_env()
+
+        # Rendered images are served from memory by result ID
+        visualization_store = VisualizationStore.from_env()
+
+        # Long studies and PDFs run as queued jobs in separate worker processes
+        job_manager = JobManager.from_env(MODEL_PATH, backend)
         return True
     except Exception as e:
         print(f"Error initializing model: {e}")
@@ -56,107 +117,517 @@ def ensure_rgb(image: np.ndarray) -> np.ndarray:
     
     return image
 
+def warmup_model():
+    """Compile and warm up every batch size the batcher can produce"""
+    global warmup_error
+    sizes = os.getenv('WARMUP_BATCH_SIZES')
+    if sizes:
+        batch_sizes = [int(size) for size in sizes.split(',') if size.strip()]
+    else:
+        batch_sizes = list(range(1, batcher.max_batch_size + 1))
+    try:
+        inference_model.warmup(batch_sizes)
+    except Exception as e:
+        warmup_error = str(e)
+        print(f"Error warming up model: {e}")
+
+def model_ready() -> bool:
+    return inference_model is not None and getattr(inference_model, 'ready', True)
+
+# Endpoints whose uploads count against admission limits
+ADMITTED_PATHS = ('/analyze', '/analyze/stream')
+
+def admission_error(error: AdmissionError) -> HTTPException:
+    """429 with Retry-After while saturated; 413 for requests that can never fit"""
+    if error.retryable:
+        return HTTPException(status_code=429, detail=str(error),
+                             headers={"Retry-After": str(admission.retry_after)})
+    return HTTPException(status_code=413, detail=str(error))
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Refuse oversized bodies, and any upload while saturated, before the body is parsed"""
+    if admission is not None and request.method == 'POST' and request.url.path in ADMITTED_PATHS:
+        length = request.headers.get('content-length')
+        try:
+            admission.check_content_length(int(length) if length and length.isdigit() else None)
+            admission.check_capacity()
+        except AdmissionError as e:
+            error = admission_error(e)
+            return JSONResponse(status_code=error.status_code, content={"detail": error.detail},
+                                headers=error.headers)
+    return await call_next(request)
+
+def upload_size(file: UploadFile) -> int:
+    """Byte size of a spooled upload without reading it into memory"""
+    size = getattr(file, 'size', None)
+    if size is not None:
+        return size
+    position = file.file.tell()
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(position)
+    return size
+
+def admit_files(files: List[UploadFile]) -> Reservation:
+    """Reserve admission capacity for a request's uploads or fail fast"""
+    try:
+        return admission.admit([upload_size(file) for file in files])
+    except AdmissionError as e:
+        raise admission_error(e)
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize model on startup"""
     if not init_model():
         raise RuntimeError("Failed to initialize model")
+    # Warm up on the inference executor so /health answers meanwhile
+    asyncio.get_running_loop().run_in_executor(pools.inference, warmup_model)
+    if job_manager is not None:
+        job_manager.start()
 
-@app.post("/analyze")
-async def analyze_images(files: List[UploadFile] = File(...)):
-    """Analyze multiple images and return detected objects with visualizations"""
-    if inference_model is None or visualizer is None:
-        raise HTTPException(status_code=503, detail="Model not initialized")
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the batching thread, job workers and worker pools on shutdown"""
+    if batcher is not None:
+        batcher.stop()
+    if job_manager is not None:
+        job_manager.stop()
+    if isinstance(inference_model, InferenceProcessPool):
+        inference_model.stop()
+    if pools is not None:
+        pools.shutdown()
+
+def device_label() -> str:
+    return str(inference_model.device) if inference_model else ''
+
+def decode_image(content: bytes, filename: str) -> np.ndarray:
+    """Decode uploaded bytes into an RGB image"""
+    with stage_timer('decode', device=device_label()):
+        # Convert to numpy array using OpenCV (matching test.py)
+        nparr = np.frombuffer(content, np.uint8)
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         
+        if image is None:
+            raise ValueError(f"Failed to decode image: {filename}")
+        
+        # Convert to RGB (matching test.py processing)
+        return ensure_rgb(image)
+
+# Visualization output formats: extension for cv2.imencode and media type
+IMAGE_FORMATS = {
+    'png': ('.png', 'image/png'),
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+}
+
+class RenderOptions(NamedTuple):
+    """How a visualization is encoded; also keys cached renders"""
+    image_format: str = 'png'
+    quality: Optional[int] = None
+    max_dimension: Optional[int] = None
+
+def encode_visualization(image: np.ndarray, options: RenderOptions) -> Tuple[bytes, str]:
+    """Downscale and encode a BGR image, returning (bytes, media type)"""
+    with stage_timer('encode', device=device_label()):
+        height, width = image.shape[:2]
+        if options.max_dimension and max(height, width) > options.max_dimension:
+            scale = options.max_dimension / max(height, width)
+            image = cv2.resize(
+                image,
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                interpolation=cv2.INTER_AREA)
+
+        extension, media_type = IMAGE_FORMATS[options.image_format]
+        params = []
+        # PNG is lossless, so quality only applies to JPEG and WebP
+        if options.image_format == 'jpeg':
+            params = [cv2.IMWRITE_JPEG_QUALITY, options.quality or 90]
+        elif options.image_format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, options.quality or 90]
+
+        ok, buffer = cv2.imencode(extension, image, params)
+        if not ok:
+            raise ValueError("Failed to encode visualization")
+        return buffer.tobytes(), media_type
+
+def render_visualization(image: np.ndarray, annotations: Dict[str, Any],
+                         options: RenderOptions = RenderOptions()) -> Tuple[bytes, str]:
+    """Draw annotations onto the image and encode it"""
+    with stage_timer('visualize', device=device_label()):
+        if annotations and len(annotations) > 0:
+            # If there are annotations, create visualization
+            visualized_image = visualizer.plot_boxes_and_masks(image, annotations)
+            # Convert back to BGR for saving
+            visualized_image = cv2.cvtColor(visualized_image, cv2.COLOR_RGB2BGR)
+        else:
+            # If no annotations, save the original image (in BGR for consistency)
+            visualized_image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    return encode_visualization(visualized_image, options)
+
+def store_visualization(data: bytes, media_type: str = 'image/png') -> str:
+    """Keep an encoded visualization in the store and return its result ID"""
+    with stage_timer('write', device=device_label()):
+        return visualization_store.put(data, media_type)
+
+def format_annotations(annotations: Dict[str, Any], mask_format: str = 'raw',
+                       mask_crop: bool = False) -> Dict[str, Any]:
+    """Convert numpy types to Python native types, encoding masks as requested"""
+    if not annotations:
+        return {}
+    with stage_timer('serialize', device=device_label()):
+        return to_json_ready(annotations, mask_format, mask_crop)
+
+async def analyze_file(file: UploadFile, mask_format: str = 'raw', mask_crop: bool = False,
+                       render: Optional[RenderOptions] = RenderOptions(),
+                       enhance: Optional[str] = None) -> Dict[str, Any]:
+    """Analyze a single uploaded image, batching inference with other requests
+
+    ``render`` selects the visualization encoding; None returns annotations only.
+    ``enhance`` overrides the deployment's enhancement mode for this image.
+    """
     try:
-        # Process batch
-        results = []
-        for file in files:
-            try:
-                # Read file content
-                content = await file.read()
-                
-                # Convert to numpy array using OpenCV (matching test.py)
-                nparr = np.frombuffer(content, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                
-                if image is None:
-                    raise ValueError(f"Failed to decode image: {file.filename}")
-                
-                # Convert to RGB (matching test.py processing)
-                processed_image = ensure_rgb(image)
-                
-                # Debug print for image shape and type
+        # Read file content
+        with stage_timer('upload_read', device=device_label()):
+            content = await file.read()
+        
+        cached = None
+        if result_cache is not None:
+            cache_key = await pools.run(
+                content_key, content, *inference_model.cache_settings(), enhance)
+            cached = await pools.run(result_cache.get, cache_key)
+
+        annotations = cached['annotations'] if cached is not None else None
+        visualization = None
+        if cached is not None and (render is None or render in cached['visualizations']):
+            if render is not None:
+                visualization = cached['visualizations'][render]
+            if DEBUG_PRINT:
+                print(f"Result cache hit for {file.filename}")
+        else:
+            processed_image = await pools.run(decode_image, content, file.filename)
+            
+            # Debug print for image shape and type
+            if DEBUG_PRINT:
                 print(f"Processing {file.filename}: shape={processed_image.shape}, dtype={processed_image.dtype}")
-                
-                # Get annotations
-                annotations = inference_model.get_annotations(processed_image)
-                
+            
+            if annotations is None:
+                # Get annotations from the shared micro-batcher
+                annotations = await asyncio.wrap_future(batcher.submit(processed_image, enhance))
+            
                 # Debug print annotations
-                print(f"Annotations for {file.filename}:")
-                print(f"Raw annotations: {annotations}")
-                
-                # Always save an image, whether or not there are annotations
-                os.makedirs("temp", exist_ok=True)
-                temp_path = f"/temp/{file.filename}"
-                
-                if annotations and len(annotations) > 0:
-                    # If there are annotations, create visualization
-                    visualized_image = visualizer.plot_boxes_and_masks(processed_image, annotations)
-                    # Convert back to BGR for saving
-                    visualized_image = cv2.cvtColor(visualized_image, cv2.COLOR_RGB2BGR)
-                    cv2.imwrite(f".{temp_path}", visualized_image)
-                else:
-                    # If no annotations, save the original image (in BGR for consistency)
-                    cv2.imwrite(f".{temp_path}", cv2.cvtColor(processed_image, cv2.COLOR_RGB2BGR))
-                
-                # Convert numpy types to Python native types
-                formatted_annotations = {}
-                if annotations:
-                    for key, value in annotations.items():
-                        if isinstance(value, np.ndarray):
-                            formatted_annotations[key] = value.tolist()
-                        elif isinstance(value, (np.int64, np.int32, np.float64, np.float32)):
-                            formatted_annotations[key] = value.item()
-                        else:
-                            formatted_annotations[key] = value
-
-                results.append({
-                    "filename": file.filename,
-                    "annotations": formatted_annotations,
-                    "visualization_path": temp_path
-                })
-                
-            except Exception as e:
-                print(f"Error processing file {file.filename}: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
-                results.append({
-                    "filename": file.filename,
-                    "error": str(e),
-                    "annotations": {},
-                    "visualization_path": None
+                if DEBUG_PRINT:
+                    print(f"Annotations for {file.filename}:")
+                    print(f"Raw annotations: {annotations}")
+            
+            if render is not None:
+                visualization = await pools.run(
+                    render_visualization, processed_image, annotations, render)
+
+            # Failed batches raise, so empty annotations mean no detections
+            if result_cache is not None:
+                visualizations = dict(cached['visualizations']) if cached is not None else {}
+                if visualization is not None:
+                    visualizations[render] = visualization
+                await pools.run(result_cache.put, cache_key, {
+                    'annotations': annotations,
+                    'visualizations': visualizations,
                 })
         
-        return {"results": results}
+        temp_path = None
+        if visualization is not None:
+            # Runs on the pool since evictions may spill to disk
+            result_id = await pools.run(store_visualization, *visualization)
+            temp_path = f"/temp/{result_id}"
+        
+        formatted_annotations = await pools.run(
+            format_annotations, annotations, mask_format, mask_crop)
+
+        return {
+            "filename": file.filename,
+            "annotations": formatted_annotations,
+            "mask_format": mask_format,
+            "visualization_path": temp_path
+        }
         
     except Exception as e:
-        print(f"Server error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        print(f"Error processing file {file.filename}: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return {
+            "filename": file.filename,
+            "error": str(e),
+            "annotations": {},
+            "visualization_path": None
+        }
+
+def check_enhance(enhance: Optional[str]):
+    if enhance is not None and enhance not in ENHANCE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid enhance '{enhance}', expected one of {', '.join(ENHANCE_MODES)}")
+
+def check_analyze_request(mask_format: str, visualize: bool, image_format: str,
+                          quality: Optional[int], max_dimension: Optional[int],
+                          enhance: Optional[str] = None) -> Optional[RenderOptions]:
+    """Validate an analyze request and return its render options (None to skip)"""
+    if inference_model is None or visualizer is None or batcher is None or pools is None or admission is None:
+        raise HTTPException(status_code=503, detail="Model not initialized")
+    if not model_ready():
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model warmup failed: {warmup_error}" if warmup_error else "Model warming up",
+            headers={"Retry-After": "5"})
+    if mask_format not in MASK_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid mask_format '{mask_format}', expected one of {', '.join(MASK_FORMATS)}")
+    if image_format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image_format '{image_format}', expected one of {', '.join(IMAGE_FORMATS)}")
+    check_enhance(enhance)
+    return RenderOptions(image_format, quality, max_dimension) if visualize else None
+
+@app.post("/analyze")
+async def analyze_images(
+    files: List[UploadFile] = File(...),
+    mask_format: str = Query('raw', description="Mask encoding: raw, rle or png"),
+    mask_crop: bool = Query(False, description="Crop each mask to its detection box"),
+    visualize: bool = Query(True, description="Render a visualization; false returns annotations only"),
+    image_format: str = Query('png', description="Visualization format: png, jpeg or webp"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="JPEG/WebP quality"),
+    max_dimension: Optional[int] = Query(None, ge=16, description="Downscale the visualization's longest side"),
+    enhance: Optional[str] = Query(None, description="Enhancement mode override: " + ', '.join(ENHANCE_MODES)),
+):
+    """Analyze multiple images and return detected objects with visualizations"""
+    render = check_analyze_request(mask_format, visualize, image_format, quality, max_dimension, enhance)
+
+    with admit_files(files):
+        try:
+            # Submit every file at once so they can share inference batches
+            results = await asyncio.gather(
+                *(analyze_file(file, mask_format, mask_crop, render, enhance) for file in files))
+            return {"results": list(results)}
+
+        except Exception as e:
+            print(f"Server error: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+@app.post("/analyze/stream")
+async def analyze_images_stream(
+    files: List[UploadFile] = File(...),
+    stream_format: str = Query('ndjson', description="Record framing: ndjson or sse"),
+    mask_format: str = Query('raw', description="Mask encoding: raw, rle or png"),
+    mask_crop: bool = Query(False, description="Crop each mask to its detection box"),
+    visualize: bool = Query(True, description="Render a visualization; false returns annotations only"),
+    image_format: str = Query('png', description="Visualization format: png, jpeg or webp"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="JPEG/WebP quality"),
+    max_dimension: Optional[int] = Query(None, ge=16, description="Downscale the visualization's longest side"),
+    enhance: Optional[str] = Query(None, description="Enhancement mode override: " + ', '.join(ENHANCE_MODES)),
+):
+    """Analyze multiple images, streaming one record per image as soon as it is ready
+
+    Records may arrive out of order; each carries its upload ``index`` and
+    ``filename``. SSE streams end with a ``done`` event.
+    """
+    render = check_analyze_request(mask_format, visualize, image_format, quality, max_dimension, enhance)
+    if stream_format not in STREAM_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid stream_format '{stream_format}', expected one of {', '.join(STREAM_FORMATS)}")
+
+    # Enough files in flight to fill a batch without decoding the whole upload at once
+    in_flight = asyncio.Semaphore(int(os.getenv('STREAM_CONCURRENCY', str(batcher.max_batch_size))))
+
+    async def analyze_indexed(index: int, file: UploadFile) -> Dict[str, Any]:
+        async with in_flight:
+            result = await analyze_file(file, mask_format, mask_crop, render, enhance)
+        return {"index": index, **result}
+
+    def frame(record: Dict[str, Any]) -> str:
+        payload = json.dumps(record)
+        if stream_format == 'sse':
+            return f"event: result\ndata: {payload}\n\n"
+        return payload + "\n"
+
+    reservation = admit_files(files)
+
+    async def records():
+        tasks = [asyncio.create_task(analyze_indexed(i, file)) for i, file in enumerate(files)]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                record = await completed
+                yield await pools.run(frame, record)
+            if stream_format == 'sse':
+                yield f"event: done\ndata: {json.dumps({'count': len(tasks)})}\n\n"
+        finally:
+            # Client went away; stop work that nobody will read
+            for task in tasks:
+                task.cancel()
+            reservation.release()
+
+    # Also release if the stream is never iterated; release is idempotent
+    return StreamingResponse(records(), media_type=STREAM_FORMATS[stream_format],
+                             background=BackgroundTask(reservation.release))
+
+def get_job_manager() -> JobManager:
+    if job_manager is None:
+        raise HTTPException(status_code=503, detail="Job queue disabled (set JOB_WORKERS to enable)")
+    return job_manager
+
+def get_job_or_404(job_id: str) -> Dict[str, Any]:
+    job = get_job_manager().store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    files: List[UploadFile] = File(...),
+    mask_format: str = Query('rle', description="Mask encoding: raw, rle or png"),
+    mask_crop: bool = Query(False, description="Crop each mask to its detection box"),
+    enhance: Optional[str] = Query(None, description="Enhancement mode override: " + ', '.join(ENHANCE_MODES)),
+):
+    """Queue images and/or PDFs for background analysis, one result per image or page"""
+    manager = get_job_manager()
+    if mask_format not in MASK_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid mask_format '{mask_format}', expected one of {', '.join(MASK_FORMATS)}")
+    check_enhance(enhance)
+    # Cheap check before spooling uploads to disk
+    if not await pools.run(manager.has_capacity):
+        raise HTTPException(status_code=429, detail="Job queue full", headers={"Retry-After": "30"})
+
+    options = {"mask_format": mask_format, "mask_crop": mask_crop, "enhance": enhance}
+    try:
+        job = await pools.run(
+            manager.submit, [(file.filename, file.file) for file in files], options)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not queue job: {e}")
+    if job is None:
+        raise HTTPException(status_code=429, detail="Job queue full", headers={"Retry-After": "30"})
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Job status and progress counts"""
+    return await pools.run(get_job_or_404, job_id)
+
+@app.get("/jobs/{job_id}/results")
+async def job_results(
+    job_id: str,
+    after: int = Query(0, ge=0, description="Return results with seq greater than this"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """Finished per-image/per-page results in completion order, paged by ``seq``"""
+    job = await pools.run(get_job_or_404, job_id)
+    results = await pools.run(job_manager.store.results, job_id, after, limit)
+    return {
+        "job": job,
+        "results": results,
+        "next": results[-1]["seq"] if results else after,
+    }
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(
+    job_id: str,
+    stream_format: str = Query('sse', description="Record framing: ndjson or sse"),
+    after: int = Query(0, ge=0, description="Resume after this result seq"),
+):
+    """Stream progress and each result as it finishes until the job ends"""
+    if stream_format not in STREAM_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid stream_format '{stream_format}', expected one of {', '.join(STREAM_FORMATS)}")
+    await pools.run(get_job_or_404, job_id)
+    poll_interval = float(os.getenv('JOB_EVENTS_POLL_SECONDS', '0.5'))
+
+    def frame(event: str, record: Dict[str, Any]) -> str:
+        payload = json.dumps(record)
+        if stream_format == 'sse':
+            return f"event: {event}\ndata: {payload}\n\n"
+        return json.dumps({"event": event, **record}) + "\n"
+
+    async def events():
+        last_seq = after
+        last_progress = None
+        while True:
+            job = await pools.run(job_manager.store.get_job, job_id)
+            if job is None:
+                return
+            results = await pools.run(job_manager.store.results, job_id, last_seq)
+            for record in results:
+                yield frame("result", record)
+                last_seq = record["seq"]
+            progress = (job["status"], job["completed"])
+            if progress != last_progress:
+                yield frame("progress", job)
+                last_progress = progress
+            # Drain any results that landed before the job turned terminal
+            if job["status"] in TERMINAL_STATUSES and len(results) < 100:
+                yield frame("done", job)
+                return
+            if not results:
+                await asyncio.sleep(poll_interval)
+
+    return StreamingResponse(events(), media_type=STREAM_FORMATS[stream_format])
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; pages already in a worker still finish"""
+    await pools.run(get_job_or_404, job_id)
+    await pools.run(job_manager.cancel, job_id)
+    return await pools.run(get_job_or_404, job_id)
 
 @app.get("/health")
-async def health_check():
-    """Health check endpoint with model status"""
+async def health_check(response: Response):
+    """Health check endpoint with model status; 503 until warmup finishes"""
+    ready = model_ready()
+    if ready:
+        status = "ready"
+    else:
+        status = "error" if warmup_error else "warming_up"
+        response.status_code = 503
+    # Pool workers each tune their own batch size; only in-process models expose one
+    batch_controller = getattr(inference_model, 'batch_controller', None)
     return {
-        "status": "healthy",
+        "status": status,
+        "warmup_error": warmup_error,
         "model_loaded": inference_model is not None and visualizer is not None,
-        "device": str(inference_model.device) if inference_model else None
+        "device": str(inference_model.device) if inference_model else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "visualization_store": visualization_store.stats() if visualization_store is not None else None,
+        "jobs": job_manager.stats() if job_manager is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+        "batch_queue_depth": batcher.queue_depth() if batcher is not None else None,
+        "inference_processes": inference_model.stats() if isinstance(inference_model, InferenceProcessPool) else None,
+        "adaptive_batch": batch_controller.stats() if batch_controller is not None else None
     }
 
-@app.get("/temp/{filename}")
-async def get_image(filename: str):
-    """Serve temporary images"""
-    file_path = f"temp/{filename}"
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="Image not found")
\ No newline at end of file
+@app.get("/metrics")
+async def metrics():
+    """Per-stage latency histograms in Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/temp/{result_id}")
+async def get_image(result_id: str, request: Request):
+    """Serve a stored visualization by result ID"""
+    # Spilled visualizations are read from disk, so keep the lookup off the event loop
+    stored = await pools.run(visualization_store.get, result_id) if visualization_store is not None else None
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    data, media_type, seconds_left = stored
+    # Result IDs are never reused, so the bytes behind one never change
+    headers = {
+        "Cache-Control": f"private, max-age={int(seconds_left)}, immutable",
+        "ETag": f'"{result_id}"',
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=media_type, headers=headers)
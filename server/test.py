@@ -5,15 +5,15 @@ import numpy as np
 from concurrent.futures import ProcessPoolExecutor
 import gc
 import torch
-from inference import OptimizedYOLOInference
+from inference import get_inferencer
 from annotate import YOLOVisualizer
 
 def process_single_image(model_path: str, image_path: Path, output_dir: Path) -> Path:
     """Process a single image file with additional debugging"""
     try:
-        # Initialize the model
-        inferencer = OptimizedYOLOInference(model_path)
-        visualizer = YOLOVisualizer(model_path)
+        # Reuse this process's model; the visualizer only draws
+        inferencer = get_inferencer(model_path)
+        visualizer = YOLOVisualizer()
         
         # Read the image
         image = cv2.imread(str(image_path))
@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from batch_sizing import AdaptiveBatchController
+
+
+def _oom_above(limit, calls):
+    def process(start, end):
+        calls.append(end - start)
+        if end - start > limit:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return list(range(start, end))
+    return process
+
+
+def test_oom_backs_off_to_a_smaller_candidate():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=8)
+    calls = []
+    assert controller.run(8, _oom_above(3, calls)) == list(range(8))
+    assert calls[:4] == [8, 6, 4, 3]
+    assert controller.backoffs == 3
+    assert controller.batch_size <= 3
+
+
+def test_oom_with_no_smaller_candidate_raises():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=8)
+    controller.restrict([8])
+    calls = []
+    with pytest.raises(RuntimeError, match="out of memory"):
+        controller.run(8, _oom_above(4, calls))
+    assert calls == [8]
+
+
+def test_oom_with_restricted_candidates_stops_at_smallest():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=8)
+    controller.restrict([4, 8])
+    calls = []
+    with pytest.raises(RuntimeError, match="out of memory"):
+        controller.run(8, _oom_above(2, calls))
+    assert calls == [8, 4]
+    assert controller.batch_size <= 4
+
+
+def test_oom_backs_off_to_the_largest_smaller_candidate():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=8)
+    controller.restrict([6, 8])
+    calls = []
+    assert controller.run(8, _oom_above(6, calls)) == list(range(8))
+    assert calls == [8, 6, 2]
+    assert controller.batch_size == 6
+
+
+def test_chosen_size_is_always_a_candidate():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=8)
+    controller.restrict([6, 8])
+    for size in range(1, 10):
+        assert controller._nearest(size) in controller.candidates
+    controller._cap = 3
+    controller.restrict([6, 8])
+    assert controller.batch_size in controller.candidates
+    assert controller._nearest(8) in controller.candidates
+
+
+def test_non_oom_errors_propagate_without_backoff():
+    controller = AdaptiveBatchController('cpu', max_size=8, initial_size=4)
+
+    def process(start, end):
+        raise ValueError("bad input")
+
+    with pytest.raises(ValueError):
+        controller.run(4, process)
+    assert controller.backoffs == 0
@@ -0,0 +1,34 @@
+import numpy as np
+
+from mask_encoding import CroppedMasks, decode_rle, encode_masks, to_json_ready
+
+
+def _degenerate():
+    masks = np.zeros((2, 20, 30), dtype=np.uint8)
+    masks[1, 5:10, 5:15] = 1
+    # Zero width, and a box clipped away past the frame edge
+    boxes = np.array([[12.0, 4.0, 12.0, 9.0], [40.0, 2.0, 50.0, 8.0]], dtype=np.float32)
+    return masks, boxes
+
+
+def test_png_degenerate_box_encodes_empty():
+    masks, boxes = _degenerate()
+    encoded = encode_masks(masks, boxes, 'png', crop=True)
+    assert encoded[0] == {'size': [5, 0], 'data': '', 'origin': [12, 4]}
+    assert encoded[1] == {'size': [6, 0], 'data': '', 'origin': [30, 2]}
+
+
+def test_rle_degenerate_box_round_trips():
+    masks, boxes = _degenerate()
+    encoded = encode_masks(masks, boxes, 'rle', crop=True)
+    assert encoded[0]['size'] == [5, 0]
+    assert decode_rle(encoded[0]).shape == (5, 0)
+
+
+def test_cropped_masks_match_dense_for_degenerate_boxes():
+    masks, boxes = _degenerate()
+    cropped = CroppedMasks([np.zeros((0, 0), np.uint8), masks[1, 5:10, 5:15]], [(0, 0), (5, 5)], (20, 30))
+    for fmt in ('raw', 'rle', 'png'):
+        for crop in (False, True):
+            dense = to_json_ready({'boxes': boxes, 'masks': masks}, fmt, crop)
+            assert to_json_ready({'boxes': boxes, 'masks': cropped}, fmt, crop) == dense
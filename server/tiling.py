@@ -0,0 +1,204 @@
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from mask_encoding import CroppedMasks, crop_mask
+from postprocess import box_iou
+
+
+class Tile(NamedTuple):
+    """A window of the source image in original pixel coordinates"""
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class TileDetection(NamedTuple):
+    """One detection from one tile, in original image coordinates.
+
+    ``mask`` is cropped to ``origin`` + its own shape, so holding every
+    tile's detections costs box area rather than tile or image area.
+    ``cut`` flags which sides (left, top, right, bottom) touch an interior
+    tile seam, i.e. where the object may continue in a neighbouring tile.
+    """
+    box: np.ndarray
+    cls: float
+    confidence: float
+    mask: np.ndarray
+    origin: Tuple[int, int]
+    tile: int
+    cut: Tuple[bool, bool, bool, bool]
+
+
+def _starts(length: int, tile_size: int, stride: int) -> List[int]:
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    # Last tile sits flush with the far edge instead of running past it
+    starts.append(length - tile_size)
+    return starts
+
+
+def tile_grid(height: int, width: int, tile_size: int = 1024, overlap: int = 128) -> List[Tile]:
+    """Overlapping tiles covering the image, row by row"""
+    stride = max(1, tile_size - overlap)
+    return [
+        Tile(x, y, min(tile_size, width), min(tile_size, height))
+        for y in _starts(height, tile_size, stride)
+        for x in _starts(width, tile_size, stride)
+    ]
+
+
+def tile_detections(annotations: Dict[str, Any], tile: Tile, tile_index: int,
+                    image_hw: Tuple[int, int], edge_margin: int = 2) -> List[TileDetection]:
+    """Move one tile's annotations into image coordinates, cropping masks to their boxes"""
+    if not annotations or len(annotations.get('boxes', ())) == 0:
+        return []
+
+    height, width = image_hw
+    offset = np.array([tile.x, tile.y, tile.x, tile.y], dtype=np.float32)
+    boxes = np.asarray(annotations['boxes'], dtype=np.float32)
+    masks = annotations.get('masks')
+
+    # Seams are tile edges that are not also image edges
+    interior = (tile.x > 0, tile.y > 0, tile.x + tile.width < width, tile.y + tile.height < height)
+
+    detections = []
+    for i, box in enumerate(boxes):
+        x1, y1 = int(np.floor(box[0])), int(np.floor(box[1]))
+        x2, y2 = int(np.ceil(box[2])), int(np.ceil(box[3]))
+        if masks is not None and len(masks):
+            mask, (x1, y1) = crop_mask(masks, i, box)
+            mask = np.ascontiguousarray(mask, dtype=np.uint8)
+        else:
+            mask = np.ones((max(0, y2 - y1), max(0, x2 - x1)), dtype=np.uint8)
+        cut = (
+            interior[0] and box[0] <= edge_margin,
+            interior[1] and box[1] <= edge_margin,
+            interior[2] and box[2] >= tile.width - edge_margin,
+            interior[3] and box[3] >= tile.height - edge_margin,
+        )
+        detections.append(TileDetection(
+            box=box + offset,
+            cls=float(annotations['classes'][i]),
+            confidence=float(annotations['confidence'][i]),
+            mask=mask,
+            origin=(tile.x + x1, tile.y + y1),
+            tile=tile_index,
+            cut=cut,
+        ))
+    return detections
+
+
+def _span_iou(a1: float, a2: float, b1: float, b2: float) -> float:
+    intersection = max(0.0, min(a2, b2) - max(a1, b1))
+    union = max(a2, b2) - min(a1, b1)
+    return intersection / union if union > 0 else 0.0
+
+
+def _continues(a: TileDetection, b: TileDetection, span_threshold: float) -> bool:
+    """True when ``a`` and ``b`` look like one object cut by the seam between their tiles"""
+    if a.tile == b.tile or a.cls != b.cls:
+        return False
+    ax1, ay1, ax2, ay2 = a.box
+    bx1, by1, bx2, by2 = b.box
+    # Across a vertical seam: one is cut on the right, the other on the left
+    for left, right in ((a, b), (b, a)):
+        if left.cut[2] and right.cut[0] and left.box[2] >= right.box[0]:
+            if _span_iou(ay1, ay2, by1, by2) >= span_threshold:
+                return True
+    # Across a horizontal seam
+    for top, bottom in ((a, b), (b, a)):
+        if top.cut[3] and bottom.cut[1] and top.box[3] >= bottom.box[1]:
+            if _span_iou(ax1, ax2, bx1, bx2) >= span_threshold:
+                return True
+    return False
+
+
+def merge_tile_detections(detections: Sequence[TileDetection], image_hw: Tuple[int, int],
+                          iou_threshold: float = 0.45, containment_threshold: float = 0.6,
+                          span_threshold: float = 0.5, max_det: int = 50) -> Dict[str, Any]:
+    """Global NMS across tiles, merging duplicates and objects split by seams.
+
+    Same-class detections are grouped when their boxes overlap by IoU, when
+    one box mostly lies inside another (a partial view from a neighbouring
+    tile), or when both are cut by the seam between their tiles and line up
+    across it. Each group becomes one detection: the union of its boxes and
+    masks with the highest confidence. Like the untiled path, at most
+    ``max_det`` detections are kept, most confident first. Masks come back
+    as ``CroppedMasks`` holding each union at its box. Returns annotations
+    in the same shape as ``process_batch``, or {} when nothing was detected.
+    """
+    if not detections:
+        return {}
+
+    count = len(detections)
+    boxes = np.stack([d.box for d in detections])
+    classes = np.array([d.cls for d in detections])
+
+    iou = box_iou(boxes, boxes)
+    areas = np.prod(np.clip(boxes[:, 2:] - boxes[:, :2], 0, None), axis=1)
+    intersection = iou * (areas[:, None] + areas[None, :]) / (1 + iou)
+    containment = intersection / np.maximum(np.minimum(areas[:, None], areas[None, :]), 1e-9)
+    overlapping = (iou > iou_threshold) | (containment > containment_threshold)
+    overlapping &= classes[:, None] == classes[None, :]
+
+    # Union-find over all pairs that belong to the same object
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    cut = [any(d.cut) for d in detections]
+    for i in range(count):
+        for j in range(i + 1, count):
+            if overlapping[i, j] or (cut[i] and cut[j] and _continues(detections[i], detections[j], span_threshold)):
+                parent[find(i)] = find(j)
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    members = sorted(groups.values(), key=lambda group: -max(detections[i].confidence for i in group))
+    members = members[:max_det]
+
+    height, width = image_hw
+    merged_boxes = np.zeros((len(members), 4), dtype=np.float32)
+    merged_classes = np.zeros(len(members), dtype=np.float32)
+    merged_confidence = np.zeros(len(members), dtype=np.float32)
+    crops, origins = [], []
+    for k, group in enumerate(members):
+        merged_boxes[k, :2] = boxes[group, :2].min(axis=0)
+        merged_boxes[k, 2:] = boxes[group, 2:].max(axis=0)
+        merged_classes[k] = detections[group[0]].cls
+        merged_confidence[k] = max(detections[i].confidence for i in group)
+
+        # The union lives in the merged box, clipped to the image like crop_to_box
+        x1, y1, x2, y2 = merged_boxes[k]
+        left = int(np.clip(np.floor(x1), 0, width))
+        top = int(np.clip(np.floor(y1), 0, height))
+        right = int(np.clip(np.ceil(x2), left, width))
+        bottom = int(np.clip(np.ceil(y2), top, height))
+        union = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        for i in group:
+            mask = detections[i].mask
+            x, y = detections[i].origin
+            # Clip each member crop to the union, which stops at the image edge
+            mx1, my1 = max(x, left), max(y, top)
+            mx2, my2 = min(x + mask.shape[1], right), min(y + mask.shape[0], bottom)
+            if mx2 <= mx1 or my2 <= my1:
+                continue
+            region = union[my1 - top:my2 - top, mx1 - left:mx2 - left]
+            np.maximum(region, mask[my1 - y:my2 - y, mx1 - x:mx2 - x], out=region)
+        crops.append(union)
+        origins.append((left, top))
+
+    return {
+        'boxes': merged_boxes,
+        'classes': merged_classes,
+        'confidence': merged_confidence,
+        'masks': CroppedMasks(crops, origins, (height, width)),
+    }
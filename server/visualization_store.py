@@ -0,0 +1,164 @@
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+# (encoded bytes, media type, expiry as monotonic seconds)
+_Entry = Tuple[bytes, str, float]
+
+_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp'}
+_MEDIA_TYPES = {extension: media_type for media_type, extension in _EXTENSIONS.items()}
+_RESULT_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class VisualizationStore:
+    """Encoded visualizations keyed by unique result ID.
+
+    Memory is an LRU bounded by ``max_bytes``; entries expire after
+    ``ttl_seconds``. With ``spill_dir`` set, entries pushed out of memory
+    are written to disk and served from there until they expire. Spilled
+    files carry their creation time as mtime, so a restarted store picks
+    them up with the time they have left and deletes the expired ones.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, ttl_seconds: float = 3600,
+                 spill_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._spilled: Dict[str, Tuple[Path, str, float]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+        self.expirations = 0
+
+        if self.spill_dir is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_spill()
+
+    @classmethod
+    def from_env(cls) -> "VisualizationStore":
+        """Build a store from VIS_STORE_MB / VIS_STORE_TTL / VIS_STORE_DIR"""
+        return cls(
+            max_bytes=int(float(os.getenv('VIS_STORE_MB', '512')) * 1024 * 1024),
+            ttl_seconds=float(os.getenv('VIS_STORE_TTL', '3600')),
+            spill_dir=os.getenv('VIS_STORE_DIR') or None,
+        )
+
+    def put(self, data: bytes, media_type: str = 'image/png') -> str:
+        """Store encoded image bytes and return a new result ID"""
+        result_id = uuid.uuid4().hex
+        expires_at = monotonic() + self.ttl_seconds
+
+        spill = []
+        with self._lock:
+            self._expire_locked()
+            self._entries[result_id] = (data, media_type, expires_at)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                old_id, entry = self._entries.popitem(last=False)
+                self._bytes -= len(entry[0])
+                self.evictions += 1
+                spill.append((old_id, entry))
+
+        for old_id, entry in spill:
+            self._spill(old_id, entry)
+        return result_id
+
+    def get(self, result_id: str) -> Optional[Tuple[bytes, str, float]]:
+        """Return (data, media_type, seconds_left) or None if unknown or expired"""
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is not None:
+                if entry[2] <= now:
+                    self._drop_locked(result_id)
+                    return None
+                self._entries.move_to_end(result_id)
+                return entry[0], entry[1], entry[2] - now
+            spilled = self._spilled.get(result_id)
+
+        if spilled is None:
+            return None
+        path, media_type, expires_at = spilled
+        if expires_at <= now:
+            with self._lock:
+                self._drop_locked(result_id)
+            return None
+        try:
+            return path.read_bytes(), media_type, expires_at - now
+        except OSError:
+            return None
+
+    def _scan_spill(self):
+        """Index files spilled before a restart, deleting those already expired"""
+        now, wall_now = monotonic(), time.time()
+        for path in self.spill_dir.iterdir():
+            if not _RESULT_ID.match(path.stem) or not path.is_file():
+                continue
+            try:
+                seconds_left = path.stat().st_mtime + self.ttl_seconds - wall_now
+                if seconds_left <= 0:
+                    path.unlink()
+                    self.expirations += 1
+                    continue
+            except OSError:
+                continue
+            media_type = _MEDIA_TYPES.get(path.suffix, 'application/octet-stream')
+            self._spilled[path.stem] = (path, media_type, now + seconds_left)
+
+    def _spill(self, result_id: str, entry: _Entry):
+        data, media_type, expires_at = entry
+        now = monotonic()
+        if self.spill_dir is None or expires_at <= now:
+            return
+        path = self.spill_dir / f"{result_id}{_EXTENSIONS.get(media_type, '')}"
+        try:
+            path.write_bytes(data)
+            # Back-date to the entry's creation so expiry survives a restart
+            created = time.time() - (self.ttl_seconds - (expires_at - now))
+            os.utime(path, (created, created))
+        except OSError as e:
+            print(f"Error spilling visualization {result_id}: {e}")
+            return
+        with self._lock:
+            self._spilled[result_id] = (path, media_type, expires_at)
+
+    def _drop_locked(self, result_id: str):
+        entry = self._entries.pop(result_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+        spilled = self._spilled.pop(result_id, None)
+        if spilled is not None:
+            try:
+                spilled[0].unlink()
+            except OSError:
+                pass
+        self.expirations += 1
+
+    def _expire_locked(self):
+        now = monotonic()
+        # Hits reorder the LRU, so expiry needs a full scan
+        expired = [rid for rid, entry in self._entries.items() if entry[2] <= now]
+        expired.extend(rid for rid, entry in self._spilled.items() if entry[2] <= now)
+        for result_id in expired:
+            self._drop_locked(result_id)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "spilled": len(self._spilled),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,52 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+
+class WorkerPools:
+    """Executors that keep blocking work off the FastAPI event loop.
+
+    ``cpu`` runs decode, visualization and encoding stages. ``inference``
+    is reserved for model forward passes, which the micro-batcher dispatches
+    onto it, so a busy model never starves the lighter stages of threads.
+    """
+
+    def __init__(self, cpu_workers: Optional[int] = None, inference_workers: int = 1):
+        if cpu_workers is None:
+            cpu_workers = min(8, max(2, (os.cpu_count() or 2) - 1))
+        self.cpu_workers = cpu_workers
+        self.inference_workers = max(1, inference_workers)
+
+        self.cpu = ThreadPoolExecutor(
+            max_workers=self.cpu_workers, thread_name_prefix="cpu-worker")
+        self.inference = ThreadPoolExecutor(
+            max_workers=self.inference_workers, thread_name_prefix="inference")
+
+    @classmethod
+    def from_env(cls, inference_workers: int = 1) -> "WorkerPools":
+        """Build pools sized by WORKER_THREADS, with one inference thread per model copy.
+
+        An in-process model is not safe to run from several threads at once,
+        so ``inference_workers`` is the number of model copies (SERVE_PROCESSES)
+        and INFERENCE_WORKERS cannot raise it; add processes to scale instead.
+        """
+        cpu_workers = os.getenv('WORKER_THREADS')
+        requested = os.getenv('INFERENCE_WORKERS')
+        if requested and int(requested) != inference_workers:
+            print(f"Ignoring INFERENCE_WORKERS={requested}: running {inference_workers} inference "
+                  f"thread(s), one per model copy (set SERVE_PROCESSES to scale)")
+        return cls(
+            cpu_workers=int(cpu_workers) if cpu_workers else None,
+            inference_workers=inference_workers,
+        )
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a CPU-bound stage in the thread pool and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu, partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        self.cpu.shutdown(wait=wait)
+        self.inference.shutdown(wait=wait)